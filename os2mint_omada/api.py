@@ -1,8 +1,14 @@
 # SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+import json
+from collections.abc import AsyncIterator
+
 import structlog
 from fastapi import APIRouter
 from fastapi import status
+from fastapi.responses import JSONResponse
+from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
 
 from os2mint_omada import depends
 from os2mint_omada.omada.event_generator import Event
@@ -20,19 +26,54 @@ async def sync_omada(
 ) -> None:
     """Force-synchronise Omada user(s) matching the given Omada filter."""
     logger.info("Synchronising Omada users", omada_filter=omada_filter)
-    raw_omada_users = await omada_api.get_users(omada_filter)
-    logger.info("Synchronising raw Omada users", omada_users=raw_omada_users)
-    for raw_omada_user in raw_omada_users:
+    async for raw_omada_user in omada_api.iter_users(omada_filter):
+        logger.debug("Synchronising raw Omada user", omada_user=raw_omada_user)
         await omada_amqp_system.publish_message(
             routing_key=Event.REFRESH,
             payload=raw_omada_user,
         )
 
 
-@router.get("/get-users")
+@router.get("/get-users", response_model=list[RawOmadaUser])
 async def get_users(
     omada_api: depends.OmadaAPI, omada_filter: str | None = None
-) -> list[RawOmadaUser]:
-    """Get Omada user(s) matching the given Omada filter."""
-    raw_omada_users = await omada_api.get_users(omada_filter)
-    return raw_omada_users
+) -> Response:
+    """Get Omada user(s) matching the given Omada filter.
+
+    The users are streamed from the Omada API as a JSON list. Errors which occur
+    before the first user is received are reported normally. If the Omada API fails
+    after that, the response has already started, so the error is logged and the
+    connection is dropped, leaving the client with a truncated response. In mirror
+    mode, supported filters are answered from the local snapshot instead.
+    """
+    mirrored = omada_api.query_mirror(omada_filter)
+    if mirrored is not None:
+        return JSONResponse(mirrored)
+
+    raw_omada_users = omada_api.iter_users(omada_filter)
+    # Retrieve the first user before responding, such that most errors from the Omada
+    # API are reported properly instead of resulting in a truncated response.
+    try:
+        first = await anext(raw_omada_users, None)
+    except BaseException:
+        await raw_omada_users.aclose()
+        raise
+
+    async def stream() -> AsyncIterator[str]:
+        """Stream the users as a JSON list without buffering the entire view."""
+        try:
+            if first is None:
+                yield "[]"
+                return
+            yield "[" + json.dumps(first)
+            async for raw_omada_user in raw_omada_users:
+                yield "," + json.dumps(raw_omada_user)
+            yield "]"
+        except Exception:
+            logger.exception("Failed to stream Omada users", omada_filter=omada_filter)
+            raise
+        finally:
+            # Ensure the Omada response is closed if the client disconnects
+            await raw_omada_users.aclose()
+
+    return StreamingResponse(stream(), media_type="application/json")
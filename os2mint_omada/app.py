@@ -7,16 +7,30 @@ from fastramqpi.ramqp import AMQPSystem
 
 from os2mint_omada import api
 from os2mint_omada.autogenerated_graphql_client import GraphQLClient
+from os2mint_omada.config import Customer
 from os2mint_omada.config import Settings
 from os2mint_omada.omada.api import OmadaAPI
 from os2mint_omada.omada.api import create_client
 from os2mint_omada.omada.event_generator import OmadaEventGenerator
+from os2mint_omada.omada.models import OmadaUser
+from os2mint_omada.omada.models import field_aliases
+from os2mint_omada.omada.store import create_store
+from os2mint_omada.omada.store import database_metadata
 from os2mint_omada.sync.frederikshavn.events import mo_router as frederikshavn_mo_router
 from os2mint_omada.sync.frederikshavn.events import (
     omada_router as frederikshavn_omada_router,
 )
+from os2mint_omada.sync.frederikshavn.models import FrederikshavnOmadaUser
 from os2mint_omada.sync.silkeborg.events import mo_router as silkeborg_mo_router
 from os2mint_omada.sync.silkeborg.events import omada_router as silkeborg_omada_router
+from os2mint_omada.sync.silkeborg.models import ManualSilkeborgOmadaUser
+from os2mint_omada.sync.silkeborg.models import SilkeborgOmadaUser
+
+# Models used to parse each customer's Omada users
+CUSTOMER_MODELS: dict[Customer, list[type[OmadaUser]]] = {
+    "frederikshavn": [FrederikshavnOmadaUser],
+    "silkeborg": [SilkeborgOmadaUser, ManualSilkeborgOmadaUser],
+}
 
 
 def create_app() -> FastAPI:
@@ -33,6 +47,10 @@ def create_app() -> FastAPI:
         settings=settings.fastramqpi,
         graphql_version=22,
         graphql_client_cls=GraphQLClient,
+        # Only require the database if it is used to store the Omada users
+        database_metadata=(
+            database_metadata if settings.omada.store == "postgres" else None
+        ),
     )
     fastramqpi.add_context(settings=settings)
     context = fastramqpi.get_context()
@@ -60,7 +78,31 @@ def create_app() -> FastAPI:
     # priority ensures the client is started before the event handlers and generator
     # tries to use it.
     fastramqpi.add_lifespan_manager(omada_client, priority=600)
-    omada_api = OmadaAPI(url=settings.omada.url, client=omada_client)
+
+    # Only retrieve the attributes used by the customer's models and delta polling
+    def select(customer: Customer) -> list[str]:
+        select = field_aliases(OmadaUser, *CUSTOMER_MODELS[customer])
+        if settings.omada.delta_attribute is not None:
+            select.append(settings.omada.delta_attribute)
+        return select
+
+    omada_api = OmadaAPI(
+        settings=settings.omada,
+        client=omada_client,
+        select=select(settings.customer),
+        views=[
+            OmadaAPI(
+                settings=settings.omada,
+                client=omada_client,
+                select=select(view.customer or settings.customer),
+                url=view.url,
+                name=view.name or str(view.url),
+            )
+            for view in settings.omada.views
+        ],
+    )
+    # Probes the API's capabilities once the client has been started
+    fastramqpi.add_lifespan_manager(omada_api, priority=650)
     fastramqpi.add_context(omada_api=omada_api)
 
     # Omada AMQP
@@ -77,6 +119,7 @@ def create_app() -> FastAPI:
         settings=settings.omada,
         api=omada_api,
         amqp_system=omada_amqp_system,
+        store=create_store(settings.omada, sessionmaker=context.get("sessionmaker")),
     )
     fastramqpi.add_lifespan_manager(omada_event_generator, priority=1101)
 
@@ -1,6 +1,7 @@
 # SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
 from pathlib import Path
+from typing import Any
 from typing import Literal
 
 from fastramqpi.config import Settings as FastRAMQPISettings
@@ -8,7 +9,12 @@ from fastramqpi.ramqp.config import AMQPConnectionSettings
 from pydantic import AnyHttpUrl
 from pydantic import BaseModel
 from pydantic import BaseSettings
-from pydantic import validator
+from pydantic import Field
+from pydantic import NonNegativeFloat
+from pydantic import NonNegativeInt
+from pydantic import PositiveFloat
+from pydantic import PositiveInt
+from pydantic import root_validator
 
 
 class OmadaOIDCSettings(BaseModel):
@@ -28,29 +34,141 @@ class OmadaAMQPConnectionSettings(AMQPConnectionSettings):
     queue_prefix = "omada"
 
 
+Customer = Literal["frederikshavn", "silkeborg"]
+
+
+class OmadaViewSettings(BaseModel):
+    # Additional OData view, e.g. of external consultants
+    url: AnyHttpUrl
+    # Name of the view in metrics and logs. Defaults to the URL.
+    name: str | None = None
+    # Retrieve the attributes of this customer's models rather than the configured
+    # customer's.
+    customer: Customer | None = None
+
+
 class OmadaSettings(BaseModel):
     # OData view: http://omada.example.org/OData/DataObjects/Identity?viewid=xxxxx
     url: AnyHttpUrl
     insecure_skip_tls_verify = False
     oidc: OmadaOIDCSettings | None = None
     basic_auth: OmadaBasicAuthSettings | None = None
+    # Additional views, which are retrieved concurrently with the main view and merged
+    # by UId. Attributes of the main view take precedence, followed by the order of
+    # the views.
+    views: list[OmadaViewSettings] = []
+
+    # HTTP client. Timeouts are in seconds; the connect and read timeouts default to
+    # the general timeout, which also bounds the time spent waiting for a connection
+    # from the pool. None disables the respective connection pool limit.
+    timeout: PositiveFloat = 60
+    connect_timeout: PositiveFloat | None = None
+    read_timeout: PositiveFloat | None = None
+    max_connections: PositiveInt | None = 100
+    max_keepalive_connections: NonNegativeInt | None = 20
+    keepalive_expiry: NonNegativeFloat | None = 5
+    http2 = False
+
+    # Number of users to request per page using $top/$skip. Server-driven paging,
+    # i.e. @odata.nextLink, is always followed. None disables client-side paging.
+    # Must not exceed the server's maximum page size, if it enforces one.
+    page_size: PositiveInt | None = None
+    # Maximum number of pages retrieved concurrently
+    page_concurrency: PositiveInt = 4
+    # Retrieve the view using this many concurrent requests for ranges of Ids, based
+    # on the Ids of the previous retrieval, for servers which do not support $skip.
+    # None disables partitioning.
+    partitions: PositiveInt | None = None
+    # Number of times a failed page is retried before giving up, and the base delay
+    # in seconds of the exponential backoff between attempts.
+    retries: NonNegativeInt = 3
+    retry_backoff: NonNegativeFloat = 1
+    # Download retrievals of the entire view to a temporary file next to the
+    # persistence file before decoding them from a memory map, instead of decoding
+    # them while they are received. This releases the connection to Omada as soon as
+    # possible, and allows failed downloads to be retried. The file is deleted after
+    # use.
+    spool: bool = False
+    # Fail Omada requests immediately after this many consecutive failed attempts,
+    # probing every `circuit_reset_timeout` seconds until Omada has recovered. Lookups
+    # are served from the snapshot, regardless of its age, while the circuit is open.
+    # None disables the circuit breaker.
+    circuit_threshold: PositiveInt | None = 10
+    circuit_reset_timeout: PositiveFloat = 30
+    # Limit the number of requests per second made to Omada, with bursts of up to
+    # `rate_limit_burst` requests. Requests are prioritised: the periodic retrieval of
+    # the view first, then lookups for CREATE/DELETE, UPDATE, and REFRESH events.
+    # None disables the rate limit.
+    rate_limit: PositiveFloat | None = None
+    rate_limit_burst: PositiveInt = 10
+    # Send a duplicate of filtered requests, e.g. Id lookups, which have not completed
+    # within this percentile of recent latencies, and use whichever completes first.
+    # At most `hedge_max_ratio` of requests are hedged. The retrieval of the entire
+    # view is never hedged. None disables hedging.
+    hedge_percentile: float | None = Field(None, gt=0, lt=100)
+    hedge_max_ratio: float = Field(0.05, gt=0, le=1)
+    # Whether the Omada API supports filters combined using `or`, in which case
+    # lookups of multiple values are batched into requests whose filters are at most
+    # `max_filter_length` characters when URL-encoded. None probes the API at startup.
+    # Lookups are limited to `lookup_concurrency` concurrent requests.
+    or_filter: bool | None = None
+    max_filter_length: PositiveInt = 2000
+    lookup_concurrency: PositiveInt = 8
+    # Send lookups which cannot be combined using `or` in OData $batch requests of up
+    # to this many filters. Falls back to individual requests if the API does not
+    # support $batch. None disables $batch.
+    batch_size: PositiveInt | None = 100
+    # Answer lookups on Id, UId and CPR-number from an in-memory snapshot of the view
+    # retrieved by the event generator, if it is at most this many seconds old.
+    # None disables the snapshot.
+    snapshot_max_age: PositiveInt | None = None
+    # Serve all lookups and `/get-users` queries of the form `<key> eq <value>` from
+    # the snapshot, regardless of its age, instead of Omada. The snapshot is loaded
+    # from the event generator's store at startup and refreshed by the event
+    # generator, so only the event generator's retrievals of the view reach Omada.
+    mirror: bool = False
+    # Cache results of filtered Omada requests for this many seconds. Entries are
+    # invalidated when the event generator detects a change. None disables the cache.
+    cache_ttl: PositiveInt | None = None
+    cache_max_size: PositiveInt = 1024
 
     amqp: OmadaAMQPConnectionSettings
+    # Seconds between full scans of the view
     interval: int = 600
+    # Poll for users changed since the last seen value of this date/time attribute,
+    # e.g. the time of the last change, every `delta_interval` seconds between full
+    # scans. Deleted users are only detected by the full scans. None disables delta
+    # polling.
+    delta_attribute: str | None = None
+    delta_interval: PositiveInt = 60
     persistence_file: Path = Path("/data/omada.json")
+    # Format of the persistence file: a JSON document, or a compact, gzip-compressed
+    # format, in which attribute names are only written once. Either format is read,
+    # regardless of this setting.
+    persistence_format: Literal["json", "compact"] = "json"
+    # Store the users seen by the event generator in the JSON persistence file, which
+    # is rewritten in every cycle, in an SQLite database next to it, named
+    # `<persistence file>.sqlite3`, or in the FastRAMQPI Postgres database, configured
+    # by `FASTRAMQPI__DATABASE__*`. Only changed users are written to the databases,
+    # which are migrated from the JSON file, if it exists, on first use. The
+    # persistence file's directory is optional with the Postgres store, unless `spool`
+    # is enabled.
+    store: Literal["json", "sqlite", "postgres"] = "json"
 
-    @validator("persistence_file", always=True)
-    def persistence_directory_exists(cls, persistence_file: Path) -> Path:
-        if not persistence_file.parent.is_dir():
+    @root_validator(skip_on_failure=True)
+    def persistence_directory_exists(cls, values: dict[str, Any]) -> dict[str, Any]:
+        if values["store"] == "postgres" and not values["spool"]:
+            return values
+        if not values["persistence_file"].parent.is_dir():
             raise ValueError("Persistence file's parent directory doesn't exist")
-        return persistence_file
+        return values
 
 
 class Settings(BaseSettings):
     fastramqpi: FastRAMQPISettings
 
     omada: OmadaSettings
-    customer: Literal["frederikshavn", "silkeborg"]
+    customer: Customer
 
     class Config:
         frozen = True
@@ -5,6 +5,7 @@ from typing import Annotated
 from fastapi import Depends
 from fastramqpi.depends import from_user_context
 from fastramqpi.ramqp import AMQPSystem
+from fastramqpi.ramqp.depends import RoutingKey
 from fastramqpi.ramqp.depends import from_context
 from fastramqpi.ramqp.depends import get_payload_as_type
 from more_itertools import only
@@ -13,7 +14,10 @@ from pydantic import parse_obj_as
 from os2mint_omada.autogenerated_graphql_client import GraphQLClient as _GraphQLClient
 from os2mint_omada.mo import MO as _MO
 from os2mint_omada.omada.api import OmadaAPI as _OmadaAPI
+from os2mint_omada.omada.event_generator import Event
 from os2mint_omada.omada.models import OmadaUser
+from os2mint_omada.omada.ratelimit import Priority
+from os2mint_omada.omada.ratelimit import request_priority
 
 GraphQLClient = Annotated[_GraphQLClient, Depends(from_context("graphql_client"))]
 
@@ -22,9 +26,19 @@ OmadaAMQPSystem = Annotated[AMQPSystem, Depends(from_user_context("omada_amqp_sy
 OmadaAPI = Annotated[_OmadaAPI, Depends(from_user_context("omada_api"))]
 
 
+# Priority of the Omada requests made by handlers of each event type
+EVENT_PRIORITIES: dict[str, Priority] = {
+    Event.CREATE: Priority.HIGH,
+    Event.DELETE: Priority.HIGH,
+    Event.UPDATE: Priority.NORMAL,
+    Event.REFRESH: Priority.LOW,
+}
+
+
 async def current_omada_user(
     amqp_user: Annotated[OmadaUser, Depends(get_payload_as_type(OmadaUser))],
     omada_api: OmadaAPI,
+    routing_key: RoutingKey,
 ) -> OmadaUser:
     """Return the latest state of an Omada user.
 
@@ -33,7 +47,13 @@ async def current_omada_user(
     invalid user forever, handlers should always use the latest data from the API. Note
     that the user might have been deleted from the Omada API view, in which case the
     data from the AMQP event payload is returned instead.
+
+    The priority of the handler's Omada requests is set from the event type, such that
+    CREATE and DELETE events are not stuck behind a large refresh.
     """
+    # Set in the handler's own context, as async dependencies are solved in the same
+    # task as the handler itself.
+    request_priority.set(EVENT_PRIORITIES.get(routing_key, Priority.NORMAL))
     # NOTE: Old versions of Omada (i.e. the version our customers use) do not support filtering on UId, so we filter on Id instead.
     api_users_raw = await omada_api.get_users_by("Id", [amqp_user.id])
     if not api_users_raw:
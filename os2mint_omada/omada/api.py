@@ -3,56 +3,1059 @@
 from __future__ import annotations
 
 import asyncio
+import codecs
+import hashlib
+import mmap
+import random
+import re
+import tempfile
+import time
+from collections import deque
+from collections.abc import AsyncGenerator
+from collections.abc import AsyncIterator
+from collections.abc import Hashable
+from collections.abc import Sequence
+from contextlib import aclosing
+from dataclasses import dataclass
+from itertools import count
+from itertools import pairwise
 from typing import Any
+from typing import AsyncContextManager
 from typing import Iterable
+from typing import Self
 from typing import Type
+from urllib.parse import quote
+from uuid import uuid4
 
 import structlog
 from fastramqpi.raclients.auth import AuthenticatedAsyncHTTPXClient
+from httpx import URL
 from httpx import AsyncClient
 from httpx import BasicAuth
+from httpx import HTTPError
+from httpx import HTTPStatusError
+from httpx import Limits
+from httpx import Request
+from httpx import Response
+from httpx import Timeout
+from httpx import codes
+from more_itertools import chunked
 from more_itertools import flatten
 from pydantic import AnyHttpUrl
 
 from os2mint_omada.config import OmadaSettings
+from os2mint_omada.omada.batch import decode_batch
+from os2mint_omada.omada.batch import encode_batch
+from os2mint_omada.omada.cache import OmadaCache
+from os2mint_omada.omada.circuit import CircuitBreaker
+from os2mint_omada.omada.hedging import Hedger
+from os2mint_omada.omada.metrics import omada_coalesced_requests
+from os2mint_omada.omada.metrics import omada_decoded_bytes
+from os2mint_omada.omada.metrics import omada_pool_wait_seconds
+from os2mint_omada.omada.metrics import omada_received_bytes
+from os2mint_omada.omada.metrics import omada_request_duration_seconds
+from os2mint_omada.omada.metrics import omada_response_size_bytes
+from os2mint_omada.omada.metrics import omada_response_users
+from os2mint_omada.omada.metrics import omada_view_retrieval_seconds
 from os2mint_omada.omada.models import RawOmadaUser
+from os2mint_omada.omada.odata import ODataDecoder
+from os2mint_omada.omada.ratelimit import Priority
+from os2mint_omada.omada.ratelimit import RateLimiter
+from os2mint_omada.omada.ratelimit import request_priority
+from os2mint_omada.omada.snapshot import CPR_KEYS
+from os2mint_omada.omada.snapshot import EQ_FILTER_REGEX
+from os2mint_omada.omada.snapshot import OmadaSnapshot
 
 logger = structlog.stdlib.get_logger()
 
+# Status codes with which servers reject `$batch` requests if they don't support them
+BATCH_UNSUPPORTED_STATUS_CODES = {
+    codes.BAD_REQUEST,
+    codes.NOT_FOUND,
+    codes.METHOD_NOT_ALLOWED,
+    codes.UNSUPPORTED_MEDIA_TYPE,
+    codes.NOT_IMPLEMENTED,
+}
+# Size of the pieces in which spooled responses are decoded
+SPOOL_CHUNK_SIZE = 1024 * 1024
+# Partition filter, as generated by `id_range_filters`
+ID_RANGE_FILTER_REGEX = re.compile(r"Id (?:ge|lt) -?\d+(?: and Id lt -?\d+)?")
 
-class OmadaAPI:
+
+def eq_filter(key: str, value: int | str) -> str:
+    """Format Omada equality filter query.
+
+    Args:
+        key: Filter key.
+        value: Filter value.
+
+    Returns: Filter query `<key> eq <value>`.
+    """
+    # Strings must be quoted
+    if isinstance(value, str):
+        return f"{key} eq '{value}'"
+    return f"{key} eq {value}"
+
+
+def or_filter(key: str, values: Iterable[int | str]) -> str:
+    """Format Omada filter query matching any of the values.
+
+    Args:
+        key: Filter key.
+        values: Filter values.
+
+    Returns: Filter query `<key> eq <value1> or <key> eq <value2> ...`.
+    """
+    return " or ".join(eq_filter(key, value) for value in values)
+
+
+def or_batches(
+    key: str, values: Iterable[int | str], max_length: int
+) -> list[list[int | str]]:
+    """Pack values into batches whose `or_filter` fits within the maximum length.
+
+    Args:
+        key: Filter key.
+        values: Filter values.
+        max_length: Maximum length of each URL-encoded filter query. A value whose
+         filter exceeds the length on its own is put in a batch by itself.
+
+    Returns: List of batches of values.
+    """
+    separator = len(quote(" or "))
+    batches: list[list[int | str]] = []
+    length = 0
+    for value in values:
+        value_length = len(quote(eq_filter(key, value)))
+        if batches and length + separator + value_length <= max_length:
+            batches[-1].append(value)
+            length += separator + value_length
+        else:
+            batches.append([value])
+            length = value_length
+    return batches
+
+
+def delta_filter(key: str, value: int | str) -> str:
+    """Construct Omada filter for users whose attribute is at least the given value.
+
+    Args:
+        key: Date/time or numeric attribute, e.g. the time of the last change.
+        value: High-water mark of the attribute, as returned by Omada.
+
+    Returns: Omada filter query.
+    """
+    # OData date/time and numeric literals are not quoted
+    return f"{key} ge {value}"
+
+
+def id_range_filters(boundaries: Sequence[int]) -> list[str]:
+    """Construct Omada filters partitioning the view into ranges of Ids.
+
+    The first and last ranges are open-ended, such that all Ids are covered.
+
+    Args:
+        boundaries: Ascending Ids at which to split the view.
+
+    Returns: Filter queries, one more than the number of boundaries.
+    """
+    filters = []
+    for lower, upper in pairwise([None, *boundaries, None]):
+        bounds = []
+        if lower is not None:
+            bounds.append(f"Id ge {lower}")
+        if upper is not None:
+            bounds.append(f"Id lt {upper}")
+        filters.append(" and ".join(bounds))
+    return filters
+
+
+def partition_boundaries(ids: Iterable[int], partitions: int) -> list[int]:
+    """Compute Ids splitting the view into partitions of roughly equal size.
+
+    Args:
+        ids: Ids of the users of the view.
+        partitions: Number of partitions.
+
+    Returns: Ascending, distinct, Ids at which to split the view.
+    """
+    ids = sorted(ids)
+    if not ids:
+        return []
+    boundaries = {ids[len(ids) * i // partitions] for i in range(1, partitions)}
+    # A boundary at the lowest Id would result in an empty first partition
+    return sorted(boundaries - {ids[0]})
+
+
+def request_kind(omada_filter: str | None) -> str:
+    """Classify Omada request by its filter, for metrics.
+
+    Args:
+        omada_filter: Omada filter query of the request.
+
+    Returns: "view" for the entire view, or a partition of it, "id" and "cpr" for
+     lookups on Id and CPR number, respectively, and "other" for any other filter.
+    """
+    if omada_filter is None or ID_RANGE_FILTER_REGEX.fullmatch(omada_filter):
+        return "view"
+    key = omada_filter.split(" ", 1)[0]
+    if key == "Id":
+        return "id"
+    if key in CPR_KEYS:
+        return "cpr"
+    return "other"
+
+
+def observe_request(
+    kind: str, status: str, duration: float, size: int, num_users: int | None
+) -> None:
+    """Record metrics of a single request to the Omada API.
+
+    Args:
+        kind: Request kind; see `request_kind`.
+        status: HTTP status code, or "error" if no response was received.
+        duration: Seconds from sending the request until the response was received.
+        size: Size of the response body as transferred, i.e. compressed.
+        num_users: Number of users returned, if known.
+    """
+    omada_request_duration_seconds.labels(kind=kind, status=status).observe(duration)
+    omada_response_size_bytes.labels(kind=kind, status=status).observe(size)
+    if num_users is not None:
+        omada_response_users.labels(kind=kind, status=status).observe(num_users)
+
+
+def _uid_tag(uid: Any) -> tuple[str, str]:
+    """Cache tag of the Omada user with the given UId."""
+    return "UId", str(uid).lower()
+
+
+class NotModified(Exception):
+    """The Omada view has not been modified since it was last retrieved."""
+
+
+@dataclass
+class ViewState:
+    """Validators of the last retrieval of the entire view.
+
+    Used to make conditional requests and to detect if the view is unchanged.
+    """
+
+    etag: str | None = None
+    last_modified: str | None = None
+    # Content hash of the raw response body
+    digest: str | None = None
+    # Whether the view retrieved with this state was identical to the previous one
+    unchanged: bool = False
+
+    @property
+    def headers(self) -> dict[str, str]:
+        """Conditional request headers."""
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class OmadaAPI(AsyncContextManager):
     def __init__(
-        self, url: AnyHttpUrl, client: AsyncClient | AuthenticatedAsyncHTTPXClient
+        self,
+        settings: OmadaSettings,
+        client: AsyncClient | AuthenticatedAsyncHTTPXClient,
+        select: Sequence[str] | None = None,
+        url: AnyHttpUrl | None = None,
+        name: str = "main",
+        views: Sequence[OmadaAPI] = (),
     ) -> None:
         """Facade for the Omada API.
 
         Args:
-            url: Omada OData URL.
+            settings: Omada-specific settings.
             client: HTTPX Client.
+            select: Optional list of attributes to retrieve for each user, used to
+             reduce the size of the responses. All attributes are retrieved if None.
+            url: URL of the OData view. Defaults to the configured URL.
+            name: Name of the view, for metrics.
+            views: APIs of additional views, whose users are merged with the users of
+             this view. They share this API's circuit breaker and rate limiter.
         """
-        self.url = url
+        self.settings = settings
+        self.url = URL(str(url or settings.url))
         self.client = client
+        self.select = select
+        self.name = name
+        self.views = views
+        self.circuit = CircuitBreaker(
+            threshold=settings.circuit_threshold,
+            reset_timeout=settings.circuit_reset_timeout,
+        )
+        self.rate_limiter: RateLimiter | None = None
+        if settings.rate_limit is not None:
+            self.rate_limiter = RateLimiter(
+                rate=settings.rate_limit, burst=settings.rate_limit_burst
+            )
+        self.hedger: Hedger | None = None
+        if settings.hedge_percentile is not None:
+            self.hedger = Hedger(
+                percentile=settings.hedge_percentile,
+                max_ratio=settings.hedge_max_ratio,
+            )
+        for view in views:
+            view.circuit = self.circuit
+            view.rate_limiter = self.rate_limiter
+        self._partition_boundaries: list[int] = []
+        self.supports_or = settings.or_filter
+        # Detected on first use
+        self.supports_batch: bool | None = None
+        self._lookup_semaphore = asyncio.Semaphore(settings.lookup_concurrency)
+        self._in_flight: dict[str | None, asyncio.Future[list[RawOmadaUser]]] = {}
+        self.snapshot: OmadaSnapshot | None = None
+        self.cache: OmadaCache | None = None
+        if settings.cache_ttl is not None:
+            self.cache = OmadaCache(
+                max_size=settings.cache_max_size, ttl=settings.cache_ttl
+            )
 
-    async def get_users(self, omada_filter: str | None = None) -> list[RawOmadaUser]:
-        """Retrieve IT users from Omada.
+    async def __aenter__(self) -> Self:
+        """Probe the capabilities of the Omada API, unless configured."""
+        if self.supports_or is None:
+            self.supports_or = await self.probe_or_filter()
+        return self
+
+    async def __aexit__(
+        self, __exc_tpe: object, __exc_value: object, __traceback: object
+    ) -> None:
+        pass
+
+    async def probe_or_filter(self) -> bool:
+        """Detect whether the Omada API supports filters combined using `or`.
+
+        Old versions of Omada reject such filters as invalid. The probe is not retried,
+        to avoid delaying startup; if Omada is unavailable, `or` is not used.
+
+        Returns: Whether `or`-combined filters are supported.
+        """
+        params = {"$filter": or_filter("Id", [-1, -2])}
+        try:
+            response = await self.client.get(self.url, params=params)
+            response.raise_for_status()
+        except HTTPStatusError as e:
+            logger.info(
+                "Omada does not support or-filters", status=e.response.status_code
+            )
+            return False
+        except HTTPError:
+            logger.warning("Failed to probe Omada for or-filters", exc_info=True)
+            return False
+        logger.info("Omada supports or-filters")
+        return True
+
+    async def iter_users(
+        self, omada_filter: str | None = None, view: ViewState | None = None
+    ) -> AsyncGenerator[RawOmadaUser, None]:
+        """Stream IT users from Omada.
+
+        The response is decoded incrementally, yielding each user as soon as it has
+        been received, so memory usage does not grow with the size of the view.
 
         Args:
             omada_filter: Optional Omada filter query.
+            view: State of the previous retrieval of the entire view. If given, the
+             view is requested conditionally, and the state is updated in-place once
+             all users have been yielded. Only used for unpaged views.
 
-        Returns: List of raw omada users (dicts).
+        Raises:
+            NotModified: If the view has not been modified according to the state.
+
+        Yields: Raw omada users (dicts).
         """
+        if not self.views:
+            async for user in self._iter_view_users(omada_filter, view):
+                yield user
+            return
+        for user in await self._get_merged_users(omada_filter, view):
+            yield user
+
+    @property
+    def attributes(self) -> set[str] | None:
+        """Attributes retrieved from all views, or None if all are retrieved."""
+        attributes: set[str] = set()
+        for api in (self, *self.views):
+            if api.select is None:
+                return None
+            attributes.update(api.select)
+        return attributes
+
+    async def _get_merged_users(
+        self, omada_filter: str | None, view: ViewState | None
+    ) -> list[RawOmadaUser]:
+        """Retrieve IT users from all views concurrently and merge them by UId.
+
+        Users must be buffered, as the same user can appear in any of the views.
+        Attributes from this view take precedence, followed by the order of the views.
+        """
+        if view is not None:
+            # The validators of a single view do not cover the merged views
+            view.etag = view.last_modified = view.digest = None
+            view.unchanged = False
+
+        async def get_users(api: OmadaAPI) -> list[RawOmadaUser]:
+            start = time.monotonic()
+            users = [u async for u in api._iter_view_users(omada_filter)]
+            if omada_filter is None:
+                omada_view_retrieval_seconds.labels(view=api.name).observe(
+                    time.monotonic() - start
+                )
+            return users
+
+        tasks = [asyncio.create_task(get_users(api)) for api in (self, *self.views)]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        merged: dict[Hashable, RawOmadaUser] = {}
+        for users in results:
+            for user in users:
+                key = str(user["UId"]).lower() if "UId" in user else id(user)
+                existing = merged.get(key)
+                merged[key] = user if existing is None else {**user, **existing}
+        return list(merged.values())
+
+    async def _iter_view_users(
+        self, omada_filter: str | None = None, view: ViewState | None = None
+    ) -> AsyncGenerator[RawOmadaUser, None]:
+        """Stream IT users from this view only; see `iter_users`."""
         params = {}
         if omada_filter is not None:
             params["$filter"] = omada_filter
+        if self.select is not None:
+            params["$select"] = ",".join(self.select)
 
         logger.info("Getting Omada IT users", params=params)
-        response = await self.client.get(self.url, params=params)
-        response.raise_for_status()
-        users = response.json()["value"]
-        logger.info("Retrieved Omada IT users")
+        num_users = 0
+        if omada_filter is None and self.settings.partitions is not None:
+            # Record the Id distribution of the view to partition the next retrieval
+            ids = []
+            async for user in self._iter_partitions(params, view):
+                num_users += 1
+                if isinstance(user.get("Id"), int):
+                    ids.append(user["Id"])
+                yield user
+            self._partition_boundaries = partition_boundaries(
+                ids, self.settings.partitions
+            )
+        else:
+            async for user in self._iter_pages(params, view):
+                num_users += 1
+                yield user
+        logger.info("Retrieved Omada IT users", num_users=num_users)
+
+    async def _iter_partitions(
+        self, params: dict[str, Any], view: ViewState | None = None
+    ) -> AsyncIterator[RawOmadaUser]:
+        """Stream users of the view using concurrent requests for ranges of Ids.
+
+        The ranges are computed from the Ids of the previous retrieval. The users of
+        all ranges are yielded as they arrive, i.e. not in order.
+        """
+        boundaries = self._partition_boundaries
+        if not boundaries:
+            # No previous retrieval to partition by
+            async for user in self._iter_pages(params, view):
+                yield user
+            return
+        if view is not None:
+            # The validators of a single partition do not cover the entire view
+            view.etag = view.last_modified = view.digest = None
+            view.unchanged = False
+
+        filters = id_range_filters(boundaries)
+        logger.info("Getting Omada view in partitions", filters=filters)
+        queue: asyncio.Queue[RawOmadaUser] = asyncio.Queue()
+
+        async def get_partition(omada_filter: str) -> None:
+            async for user in self._iter_pages({**params, "$filter": omada_filter}):
+                queue.put_nowait(user)
+
+        tasks = [asyncio.create_task(get_partition(f)) for f in filters]
+        running = set(tasks)
+        try:
+            while True:
+                while not queue.empty():
+                    yield queue.get_nowait()
+                if not running:
+                    break
+                get = asyncio.ensure_future(queue.get())
+                waiters: set[asyncio.Future[Any]] = {get, *running}
+                done, _ = await asyncio.wait(
+                    waiters, return_when=asyncio.FIRST_COMPLETED
+                )
+                if get.done():
+                    yield get.result()
+                else:
+                    # Cancelling the getter does not lose any items
+                    get.cancel()
+                for task in done - {get}:
+                    running.discard(task)
+                    # Raise if the partition failed
+                    task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _iter_pages(
+        self, params: dict[str, Any], view: ViewState | None = None
+    ) -> AsyncIterator[RawOmadaUser]:
+        """Stream users from all pages of the view.
+
+        Server-driven paging through `@odata.nextLink` is always followed. Otherwise,
+        if a page size is configured, the remaining pages are requested concurrently
+        using `$top` and `$skip` after the first page. Without a page size, the first
+        page, which is usually the entire view, is streamed rather than buffered.
+        """
+        page_size = self.settings.page_size
+        if page_size is None:
+            metadata: dict[str, Any] = {}
+            async for user in self._iter_page(self.url, params, metadata, view):
+                yield user
+        else:
+            # OData does not guarantee a stable order across requests, which could
+            # cause users to be skipped or duplicated between pages.
+            params = {"$orderby": "Id", **params}
+            first_page, metadata = await self._get_page(
+                self.url, {**params, "$top": page_size}
+            )
+            for user in first_page:
+                yield user
+            # If the page is longer than requested, the server does not support $top
+            # and returned the entire view.
+            if (
+                "@odata.nextLink" not in metadata
+                and first_page
+                and len(first_page) <= page_size
+            ):
+                async for user in self._iter_skip_pages(params, first_page):
+                    yield user
+                return
+
+        # Server-driven paging
+        next_link = metadata.get("@odata.nextLink")
+        if view is not None and (page_size is not None or next_link is not None):
+            # The validators of a single page do not cover the entire view
+            view.etag = view.last_modified = view.digest = None
+            view.unchanged = False
+        while next_link is not None:
+            page, metadata = await self._get_page(self.url.join(next_link), {})
+            for user in page:
+                yield user
+            next_link = metadata.get("@odata.nextLink")
+
+    async def _iter_skip_pages(
+        self, params: dict[str, Any], first_page: list[RawOmadaUser]
+    ) -> AsyncIterator[RawOmadaUser]:
+        """Stream users from the pages following the first using `$top` and `$skip`.
+
+        Pages are retrieved concurrently, but yielded in order. The view ends at the
+        first empty page, since a short page might just as well be caused by the server
+        enforcing a smaller maximum page size.
+        """
+        page_size = self.settings.page_size
+        assert page_size is not None
+
+        async def get_page(skip: int) -> list[RawOmadaUser]:
+            page_params = {**params, "$top": page_size, "$skip": skip}
+            users, _ = await self._get_page(self.url, page_params)
+            return users
+
+        pages: deque[asyncio.Task[list[RawOmadaUser]]] = deque()
+        skip = page_size
+        previous = first_page
+        try:
+            while True:
+                while len(pages) < self.settings.page_concurrency:
+                    pages.append(asyncio.create_task(get_page(skip)))
+                    skip += page_size
+                page = await pages.popleft()
+                if not page:
+                    return
+                # Silently returning a partial view would cause the event generator to
+                # delete the missing users, so inconsistent paging is an error.
+                if len(previous) < page_size:
+                    raise ValueError(
+                        "Omada returned fewer users than requested before the end of "
+                        "the view: page_size exceeds the server's maximum page size"
+                    )
+                if page[0] == previous[0]:
+                    raise ValueError(
+                        "Omada returned the same page twice: the server does not "
+                        "support $skip, so page_size must be disabled"
+                    )
+                for user in page:
+                    yield user
+                previous = page
+        finally:
+            for task in pages:
+                task.cancel()
+            await asyncio.gather(*pages, return_exceptions=True)
+
+    async def _iter_page(
+        self,
+        url: URL,
+        params: dict[str, Any],
+        metadata: dict[str, Any],
+        view: ViewState | None = None,
+    ) -> AsyncIterator[RawOmadaUser]:
+        """Stream users from a single page.
+
+        Since users are yielded as they are received, the page is only retried if it
+        fails before any of them have been yielded.
+
+        Args:
+            url: Page URL.
+            params: Query parameters.
+            metadata: Dict which is updated with the page's top-level attributes, such
+             as `@odata.nextLink`, after all users have been yielded.
+            view: Optional state for conditional requests; see `iter_users`.
+
+        Yields: Raw omada users (dicts).
+        """
+        for attempt in count(1):
+            decoder = ODataDecoder()
+            yielded = False
+            try:
+                async for user in self._stream_page(url, params, decoder, view):
+                    yielded = True
+                    yield user
+            except HTTPError as e:
+                if yielded:
+                    raise
+                await self._backoff(e, attempt)
+                continue
+            metadata.update(decoder.metadata)
+            return
+
+    async def _get_page(
+        self, url: URL, params: dict[str, Any]
+    ) -> tuple[list[RawOmadaUser], dict[str, Any]]:
+        """Retrieve a single page.
+
+        The page is buffered, so it can be retried on its own if it fails at any point.
+
+        Args:
+            url: Page URL.
+            params: Query parameters.
+
+        Returns: Tuple of the page's users and other top-level attributes, such as
+         `@odata.nextLink`.
+        """
+        for attempt in count(1):
+            decoder = ODataDecoder()
+            try:
+                users = [u async for u in self._stream_page(url, params, decoder)]
+            except HTTPError as e:
+                await self._backoff(e, attempt)
+                continue
+            return users, decoder.metadata
+        raise AssertionError("unreachable")  # pragma: no cover
+
+    async def _stream_page(
+        self,
+        url: URL,
+        params: dict[str, Any],
+        decoder: ODataDecoder,
+        view: ViewState | None = None,
+    ) -> AsyncIterator[RawOmadaUser]:
+        """Request a single page and decode its users as they are received."""
+        headers = view.headers if view is not None else {}
+        digest = hashlib.sha256()
+        kind = request_kind(params.get("$filter", url.params.get("$filter")))
+        num_bytes = 0
+        if self.rate_limiter is not None:
+            priority = Priority.VIEW if kind == "view" else request_priority.get()
+            await self.rate_limiter.acquire(priority)
+        self.circuit.check()
+        start = time.monotonic()
+        status = "error"
+        num_users = 0
+        received = 0
+        try:
+            async with self.client.stream(
+                "GET", url, params=params, headers=headers
+            ) as response:
+                status = str(response.status_code)
+                try:
+                    if view is not None and response.status_code == codes.NOT_MODIFIED:
+                        self.circuit.success()
+                        raise NotModified()
+                    response.raise_for_status()
+                    text_decoder = codecs.getincrementaldecoder(
+                        response.encoding or "utf-8"
+                    )()
+                    body = self._iter_body(response, spool=kind == "view")
+                    async with aclosing(body):
+                        async for chunk in body:
+                            num_bytes += len(chunk)
+                            if view is not None:
+                                digest.update(chunk)
+                            for user in decoder.feed(text_decoder.decode(chunk)):
+                                num_users += 1
+                                yield user
+                    for user in decoder.feed(text_decoder.decode(b"", final=True)):
+                        num_users += 1
+                        yield user
+                finally:
+                    # Count failed and aborted transfers too; they use bandwidth all
+                    # the same.
+                    received = response.num_bytes_downloaded
+                    omada_received_bytes.labels(kind=kind).inc(received)
+                    omada_decoded_bytes.labels(kind=kind).inc(num_bytes)
+            self.circuit.success()
+            for user in decoder.close():
+                num_users += 1
+                yield user
+        finally:
+            observe_request(kind, status, time.monotonic() - start, received, num_users)
+
+        if view is not None:
+            view.etag = response.headers.get("ETag")
+            view.last_modified = response.headers.get("Last-Modified")
+            view.unchanged = digest.hexdigest() == view.digest
+            view.digest = digest.hexdigest()
+
+    async def _iter_body(
+        self, response: Response, spool: bool
+    ) -> AsyncGenerator[bytes, None]:
+        """Iterate the response body.
+
+        If spooling is enabled, the entire body is first downloaded to a temporary
+        file in the persistence directory, and the connection released, before it is
+        read back through a memory map. The body is thus held by the page cache rather
+        than the process, and a failed download can be retried before any users have
+        been yielded.
+
+        Args:
+            response: Streaming response.
+            spool: Whether the response should be spooled, if enabled.
+
+        Yields: Pieces of the (decompressed) response body.
+        """
+        if not spool or not self.settings.spool:
+            async for chunk in response.aiter_bytes():
+                yield chunk
+            return
+
+        directory = self.settings.persistence_file.parent
+        with tempfile.TemporaryFile(dir=directory, prefix=".omada-spool-") as file:
+            async for chunk in response.aiter_bytes():
+                file.write(chunk)
+            await response.aclose()
+            file.flush()
+            size = file.tell()
+            logger.debug("Spooled Omada response", size=size)
+            if size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as body:
+                for offset in range(0, size, SPOOL_CHUNK_SIZE):
+                    yield body[offset : offset + SPOOL_CHUNK_SIZE]
+
+    async def _backoff(self, error: HTTPError, attempt: int) -> None:
+        """Wait before retrying a failed request, or re-raise if it shouldn't be.
+
+        Server errors, rate-limiting and transport errors are retried with jittered
+        exponential backoff, and count towards opening the circuit. Other client
+        errors, e.g. an invalid filter, are not retried.
+        """
+        retryable = (
+            not isinstance(error, HTTPStatusError)
+            or error.response.status_code == 429
+            or error.response.status_code >= 500
+        )
+        if not retryable:
+            self.circuit.success()
+            raise error
+        self.circuit.failure()
+        if attempt > self.settings.retries or self.circuit.is_open:
+            raise error
+        wait = random.uniform(0, self.settings.retry_backoff * 2**attempt)
+        logger.warning(
+            "Retrying failed Omada request",
+            url=error.request.url,
+            attempt=attempt,
+            wait=wait,
+        )
+        await asyncio.sleep(wait)
+
+    async def get_users(self, omada_filter: str | None = None) -> list[RawOmadaUser]:
+        """Retrieve IT users from Omada.
+
+        Filtered results are cached if enabled. Concurrent calls with the same filter
+        share a single request to Omada. The returned users are therefore shared
+        between callers, and must not be mutated.
+
+        Args:
+            omada_filter: Optional Omada filter query.
+
+        Returns: List of raw omada users (dicts).
+        """
+        users = self.query_mirror(omada_filter)
+        if users is not None:
+            return users
+
+        cache = self.cache
+        # The entire view is never cached
+        if cache is None or omada_filter is None:
+            return await self._get_users_coalesced(omada_filter)
+
+        users = cache.get(omada_filter)
+        if users is not None:
+            logger.debug("Using cached Omada users", omada_filter=omada_filter)
+            return list(users)
+        generation = cache.generation
+        users = await self._get_users_coalesced(omada_filter)
+        self._cache_users(cache, omada_filter, users, generation)
+        return users
+
+    @staticmethod
+    def _cache_users(
+        cache: OmadaCache,
+        omada_filter: str,
+        users: list[RawOmadaUser],
+        generation: int,
+    ) -> None:
+        """Cache the result of a filtered request.
+
+        Args:
+            cache: The cache.
+            omada_filter: Omada filter query of the request.
+            users: Raw Omada users returned by the request.
+            generation: Cache generation from before the request was made.
+        """
+        # Results of simple equality filters are invalidated precisely through their
+        # filter, while results of other filters are invalidated by any change.
+        cache.set(
+            omada_filter,
+            list(users),
+            tags={omada_filter, *(_uid_tag(u["UId"]) for u in users if "UId" in u)},
+            generation=generation,
+            generational=EQ_FILTER_REGEX.fullmatch(omada_filter) is None,
+        )
+
+    async def get_users_batch(
+        self, omada_filters: Sequence[str]
+    ) -> list[list[RawOmadaUser]]:
+        """Retrieve IT users for multiple filters using as few requests as possible.
+
+        Filters which are not cached are sent in OData `$batch` requests of up to
+        `batch_size` filters each. If `$batch` is not supported, or a filter fails
+        within a batch, the filter is retrieved using an individual request instead.
+
+        Args:
+            omada_filters: Omada filter queries.
+
+        Returns: List of raw omada users (dicts) for each filter, in the same order.
+        """
+        results: list[list[RawOmadaUser] | None] = [None] * len(omada_filters)
+        cache = self.cache
+        if cache is not None:
+            results = [cache.get(f) for f in omada_filters]
+        missing = [i for i, users in enumerate(results) if users is None]
+
+        batch_size = self.settings.batch_size
+        # $batch requests only cover this view
+        if (
+            batch_size is not None
+            and self.supports_batch is not False
+            and not self.views
+        ):
+            generation = cache.generation if cache is not None else 0
+            batches = [b for b in chunked(missing, batch_size) if len(b) > 1]
+
+            async def get_batch(batch: list[int]) -> None:
+                async with self._lookup_semaphore:
+                    responses = await self._get_batch([omada_filters[i] for i in batch])
+                for i, users in zip(batch, responses):
+                    results[i] = users
+                    if users is not None and cache is not None:
+                        self._cache_users(cache, omada_filters[i], users, generation)
+
+            await asyncio.gather(*(get_batch(b) for b in batches))
+
+        async def get_users(i: int) -> None:
+            async with self._lookup_semaphore:
+                results[i] = await self.get_users(omada_filters[i])
+
+        missing = [i for i, users in enumerate(results) if users is None]
+        await asyncio.gather(*(get_users(i) for i in missing))
+        assert all(users is not None for users in results)
+        return [list(users) for users in results if users is not None]
+
+    async def _get_batch(
+        self, omada_filters: list[str]
+    ) -> list[list[RawOmadaUser] | None]:
+        """Retrieve IT users for multiple filters in a single `$batch` request.
+
+        Args:
+            omada_filters: Omada filter queries.
+
+        Returns: List of raw omada users (dicts) for each filter, in the same order,
+         or None for filters which failed. All are None if `$batch` is unsupported.
+        """
+        results: list[list[RawOmadaUser] | None] = [None] * len(omada_filters)
+        urls = []
+        for omada_filter in omada_filters:
+            params = {"$filter": omada_filter}
+            if self.select is not None:
+                params["$select"] = ",".join(self.select)
+            urls.append(str(self.url.copy_merge_params(params)))
+        boundary = f"batch_{uuid4()}"
+        content = encode_batch(urls, boundary)
+        headers = {"Content-Type": f"multipart/mixed; boundary={boundary}"}
+
+        logger.debug("Getting Omada IT users in batch", omada_filters=omada_filters)
+        for attempt in count(1):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire(request_priority.get())
+            self.circuit.check()
+            start = time.monotonic()
+            try:
+                response = await self.client.post(
+                    self.url.join("$batch"), content=content, headers=headers
+                )
+                observe_request(
+                    "other",
+                    str(response.status_code),
+                    time.monotonic() - start,
+                    response.num_bytes_downloaded,
+                    None,
+                )
+                if response.status_code in BATCH_UNSUPPORTED_STATUS_CODES:
+                    self.circuit.success()
+                    logger.info(
+                        "Omada does not support $batch", status=response.status_code
+                    )
+                    self.supports_batch = False
+                    return results
+                response.raise_for_status()
+            except HTTPError as e:
+                if not isinstance(e, HTTPStatusError):
+                    observe_request("other", "error", time.monotonic() - start, 0, None)
+                await self._backoff(e, attempt)
+                continue
+            self.circuit.success()
+            break
+
+        try:
+            responses = decode_batch(
+                response.headers.get("Content-Type", ""), response.content
+            )
+        except ValueError:
+            logger.warning("Failed to decode Omada $batch response", exc_info=True)
+            self.supports_batch = False
+            return results
+        if len(responses) != len(omada_filters):
+            logger.warning("Incomplete Omada $batch response")
+            return results
+        self.supports_batch = True
+
+        for i, batch_response in enumerate(responses):
+            if not codes.is_success(batch_response.status_code):
+                logger.warning(
+                    "Omada $batch request failed",
+                    omada_filter=omada_filters[i],
+                    status=batch_response.status_code,
+                )
+                continue
+            decoder = ODataDecoder()
+            results[i] = decoder.feed(batch_response.content.decode()) + decoder.close()
+        return results
+
+    def invalidate(self, users: Iterable[RawOmadaUser]) -> None:
+        """Invalidate cached results which might contain or match the given users.
+
+        Args:
+            users: Omada users (dicts), both before and after a change.
+        """
+        if self.cache is None:
+            return
+        tags: set[Hashable] = set()
+        for user in users:
+            for key, value in user.items():
+                if isinstance(value, int | str) and not isinstance(value, bool):
+                    tags.add(eq_filter(key, value))
+            if "UId" in user:
+                tags.add(_uid_tag(user["UId"]))
+        self.cache.invalidate(tags)
+
+    async def _get_users_coalesced(
+        self, omada_filter: str | None
+    ) -> list[RawOmadaUser]:
+        """Retrieve IT users, sharing identical concurrent requests."""
+        request = self._in_flight.get(omada_filter)
+        if request is None:
+            request = asyncio.ensure_future(self._get_users(omada_filter))
+            self._in_flight[omada_filter] = request
+            request.add_done_callback(lambda _: self._in_flight.pop(omada_filter))
+        else:
+            logger.debug("Coalescing Omada request", omada_filter=omada_filter)
+            omada_coalesced_requests.inc()
+        # Shield the shared request to avoid cancelling it for the other callers
+        users = await asyncio.shield(request)
+        return list(users)
+
+    async def _get_users(self, omada_filter: str | None) -> list[RawOmadaUser]:
+        async def get_users() -> list[RawOmadaUser]:
+            return [user async for user in self.iter_users(omada_filter)]
+
+        # Only small, filtered, requests are hedged; never the entire view
+        if self.hedger is not None and omada_filter is not None:
+            users = await self.hedger.run(get_users)
+        else:
+            users = await get_users()
         logger.debug("Retrieved Omada IT users", users=users)
         return users
 
+    def update_snapshot(self, users: Iterable[RawOmadaUser], timestamp: float) -> None:
+        """Replace the snapshot used to answer `get_users_by` lookups.
+
+        Args:
+            users: Raw Omada users of the entire view.
+            timestamp: Monotonic time at which the view was retrieved.
+        """
+        if self.settings.snapshot_max_age is None and not self.settings.mirror:
+            return
+        self.snapshot = OmadaSnapshot(users, timestamp)
+
+    def query_mirror(self, omada_filter: str | None) -> list[RawOmadaUser] | None:
+        """Answer Omada filter query from the snapshot, if running in mirror mode.
+
+        Args:
+            omada_filter: Optional Omada filter query.
+
+        Returns: List of raw omada users (dicts), or None if the query must be sent to
+         Omada; because mirror mode is disabled, no snapshot has been retrieved yet, or
+         the filter is not supported by the snapshot.
+        """
+        snapshot = self.snapshot
+        if not self.settings.mirror or snapshot is None:
+            return None
+        users = snapshot.query(omada_filter)
+        if users is not None:
+            logger.debug("Using Omada mirror", omada_filter=omada_filter)
+        return users
+
+    def touch_snapshot(self, timestamp: float) -> None:
+        """Mark the snapshot as up to date, as the view was not modified.
+
+        Args:
+            timestamp: Monotonic time at which the view was found to be unmodified.
+        """
+        if self.snapshot is not None:
+            self.snapshot.timestamp = timestamp
+
     async def get_users_by(
         self, key: str, values: Iterable[int | str]
     ) -> list[RawOmadaUser]:
@@ -64,17 +1067,59 @@ class OmadaAPI:
 
         Returns: List of raw omada users matching the filter.
         """
+        values = list(values)
+        snapshot = self.snapshot
+        if self.settings.mirror and snapshot is not None:
+            logger.debug("Using Omada mirror", key=key, values=values)
+            return list(flatten(snapshot.lookup(key, value) for value in values))
+        max_age = self.settings.snapshot_max_age
+        if (
+            snapshot is not None
+            and max_age is not None
+            and key in snapshot.keys
+            and (snapshot.age <= max_age or self.circuit.is_open)
+        ):
+            if snapshot.age > max_age:
+                logger.warning(
+                    "Using stale Omada snapshot as the circuit is open",
+                    age=snapshot.age,
+                )
+            logger.debug("Using Omada snapshot", key=key, values=values)
+            return list(flatten(snapshot.lookup(key, value) for value in values))
+
+        if self.supports_or and len(values) > 1:
+            batches = or_batches(key, values, self.settings.max_filter_length)
+            filters = [or_filter(key, batch) for batch in batches]
+        else:
+            # Old versions of Omada do not support OR or IN operators, so we have to
+            # do it like this.
+            filters = [eq_filter(key, value) for value in values]
+
+        if len(filters) == 1:
+            return await self.get_users(filters[0])
+        return list(flatten(await self.get_users_batch(filters)))
+
+
+async def trace_pool_wait(request: Request) -> None:
+    """Request event hook which measures the time spent waiting for a connection.
+
+    HTTPX does not expose pool waits directly, but the connection pool does not emit
+    any trace events until a connection has been assigned to the request, so the
+    first event marks the end of the wait.
+
+    Args:
+        request: Request about to be sent.
+    """
+    start = time.monotonic()
+    observed = False
 
-        def format(value: int | str) -> str:
-            # Strings must be quoted
-            if isinstance(value, str):
-                return f"'{value}'"
-            return str(value)
+    async def trace(event: str, info: dict[str, Any]) -> None:
+        nonlocal observed
+        if not observed:
+            observed = True
+            omada_pool_wait_seconds.observe(time.monotonic() - start)
 
-        # Omada does not support OR or IN operators, so we have to do it like this
-        get_users = (self.get_users(f"{key} eq {format(value)}") for value in values)
-        users = await asyncio.gather(*get_users)
-        return list(flatten(users))
+    request.extensions["trace"] = trace
 
 
 def create_client(
@@ -89,7 +1134,20 @@ def create_client(
     """
     client_cls: Type[AsyncClient | AuthenticatedAsyncHTTPXClient] = AsyncClient
     kwargs: dict[str, Any] = dict(
-        timeout=60,
+        timeout=Timeout(
+            settings.timeout,
+            connect=settings.connect_timeout or settings.timeout,
+            read=settings.read_timeout or settings.timeout,
+        ),
+        limits=Limits(
+            max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_keepalive_connections,
+            keepalive_expiry=settings.keepalive_expiry,
+        ),
+        http2=settings.http2,
+        # The view is verbose JSON, which compresses very well
+        headers={"Accept-Encoding": "gzip, deflate, br"},
+        event_hooks={"request": [trace_pool_wait]},
     )
     if settings.insecure_skip_tls_verify:
         logger.warning("INSECURE: Skipping TLS verification for Omada API!")
@@ -0,0 +1,75 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from __future__ import annotations
+
+import re
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+BOUNDARY_REGEX = re.compile(r'boundary="?([^";]+)"?')
+STATUS_LINE_REGEX = re.compile(rb"HTTP/\d(?:\.\d)? (\d{3})")
+
+
+@dataclass
+class BatchResponse:
+    """Response to a single request of a batch."""
+
+    status_code: int
+    content: bytes
+
+
+def encode_batch(urls: Iterable[str], boundary: str) -> bytes:
+    """Encode GET requests as a multipart `$batch` request body.
+
+    Args:
+        urls: Absolute URLs, including query parameters, of the GET requests.
+        boundary: Multipart boundary, which must also be given in the Content-Type
+         header as `multipart/mixed; boundary=<boundary>`.
+
+    Returns: Request body.
+    """
+    parts = [
+        f"--{boundary}\r\n"
+        "Content-Type: application/http\r\n"
+        "Content-Transfer-Encoding: binary\r\n"
+        "\r\n"
+        f"GET {url} HTTP/1.1\r\n"
+        "Accept: application/json\r\n"
+        "\r\n"
+        for url in urls
+    ]
+    return "".join([*parts, f"--{boundary}--\r\n"]).encode()
+
+
+def decode_batch(content_type: str, body: bytes) -> list[BatchResponse]:
+    """Decode multipart `$batch` response body.
+
+    Args:
+        content_type: Content-Type header of the response.
+        body: Response body.
+
+    Returns: Responses, in the order of the requests.
+    """
+    match = BOUNDARY_REGEX.search(content_type)
+    if not content_type.startswith("multipart/mixed") or match is None:
+        raise ValueError(f"Invalid $batch response content type: {content_type}")
+    delimiter = f"--{match.group(1)}".encode()
+
+    responses = []
+    # The first part is the preamble, and the last the epilogue after the final "--"
+    for part in body.split(delimiter)[1:-1]:
+        # Each part consists of its MIME headers and the embedded HTTP response, which
+        # has a status line, headers and body.
+        _, _, http_response = part.partition(b"\r\n\r\n")
+        head, _, content = http_response.partition(b"\r\n\r\n")
+        status = STATUS_LINE_REGEX.match(head)
+        if status is None:
+            raise ValueError("Invalid $batch response part")
+        # Strip the line break preceding the next delimiter
+        responses.append(
+            BatchResponse(
+                status_code=int(status.group(1)),
+                content=content.removesuffix(b"\r\n"),
+            )
+        )
+    return responses
@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from collections import defaultdict
+from collections.abc import Hashable
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+from os2mint_omada.omada.metrics import omada_cache_hits
+from os2mint_omada.omada.metrics import omada_cache_misses
+from os2mint_omada.omada.models import RawOmadaUser
+
+
+@dataclass
+class _Entry:
+    users: list[RawOmadaUser]
+    expires: float
+    tags: frozenset[Hashable]
+    # Generation the entry was cached in, if it should be invalidated on any change
+    generation: int | None
+
+
+class OmadaCache:
+    def __init__(self, max_size: int, ttl: float) -> None:
+        """Bounded-size LRU cache of Omada filter results with time-to-live.
+
+        Entries are invalidated on changes in two ways: Entries which can be related to
+        a user through tags, e.g. the users' UId or a `<key> eq <value>` filter, are
+        invalidated when that user changes. Other entries are invalidated when any
+        user changes, by bumping the cache's generation.
+
+        Args:
+            max_size: Maximum number of entries.
+            ttl: Number of seconds an entry is valid for.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._keys_by_tag: defaultdict[Hashable, set[str]] = defaultdict(set)
+
+    def get(self, key: str) -> list[RawOmadaUser] | None:
+        """Return cached users for the key, if any."""
+        entry = self._entries.get(key)
+        if entry is None or not self._is_valid(entry):
+            if entry is not None:
+                self._remove(key)
+            omada_cache_misses.inc()
+            return None
+        self._entries.move_to_end(key)
+        omada_cache_hits.inc()
+        return entry.users
+
+    def set(
+        self,
+        key: str,
+        users: list[RawOmadaUser],
+        tags: Iterable[Hashable],
+        generation: int,
+        generational: bool,
+    ) -> None:
+        """Cache users for the key.
+
+        Args:
+            key: Cache key.
+            users: Users to cache.
+            tags: Tags which invalidate the entry.
+            generation: Generation at the time the users were requested. The users are
+             not cached if anything was invalidated since, as they might be stale.
+            generational: Whether the entry is invalidated by any change.
+        """
+        if generation != self.generation:
+            return
+        if key in self._entries:
+            self._remove(key)
+        entry = _Entry(
+            users=users,
+            expires=time.monotonic() + self.ttl,
+            tags=frozenset(tags),
+            generation=generation if generational else None,
+        )
+        self._entries[key] = entry
+        for tag in entry.tags:
+            self._keys_by_tag[tag].add(key)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags: Iterable[Hashable]) -> None:
+        """Invalidate entries with any of the given tags, and all generational ones."""
+        self.generation += 1
+        for tag in tags:
+            for key in list(self._keys_by_tag.get(tag, ())):
+                self._remove(key)
+
+    def _is_valid(self, entry: _Entry) -> bool:
+        if entry.expires < time.monotonic():
+            return False
+        return entry.generation is None or entry.generation == self.generation
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        for tag in entry.tags:
+            keys = self._keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_tag[tag]
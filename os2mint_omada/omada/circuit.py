@@ -0,0 +1,85 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from __future__ import annotations
+
+import time
+from enum import IntEnum
+
+import structlog
+
+from os2mint_omada.omada.metrics import omada_circuit_state
+
+logger = structlog.stdlib.get_logger()
+
+
+class CircuitOpenError(Exception):
+    """Omada is considered unavailable; the request was not attempted."""
+
+
+class CircuitState(IntEnum):
+    """Circuit state, as exported by the `omada_circuit_state` gauge."""
+
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int | None, reset_timeout: float) -> None:
+        """Circuit breaker for the Omada API.
+
+        The circuit opens after `threshold` consecutive failures. While it is open,
+        requests fail immediately with `CircuitOpenError` instead of adding load to an
+        Omada which is already struggling. Every `reset_timeout` seconds, a single
+        request is let through to probe whether Omada has recovered; the circuit
+        closes on the first success.
+
+        Args:
+            threshold: Number of consecutive failures before opening the circuit.
+             None disables the circuit breaker.
+            reset_timeout: Seconds between probes while the circuit is open.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at: float | None = None
+        self._set_state(CircuitState.CLOSED)
+
+    @property
+    def is_open(self) -> bool:
+        return self.state is not CircuitState.CLOSED
+
+    def _set_state(self, state: CircuitState) -> None:
+        self.state = state
+        omada_circuit_state.set(state)
+
+    def check(self) -> None:
+        """Raise `CircuitOpenError` if a request should not be attempted."""
+        if self._opened_at is None:
+            return
+        now = time.monotonic()
+        if now - self._opened_at < self.reset_timeout:
+            raise CircuitOpenError("Omada circuit is open")
+        # Let this request through as a probe. Moving the timestamp ensures that
+        # concurrent requests still fail fast, and that another probe is let through
+        # later even if this one never reports back.
+        self._opened_at = now
+        self._set_state(CircuitState.HALF_OPEN)
+
+    def success(self) -> None:
+        """Record a successful request."""
+        self.failures = 0
+        if self._opened_at is not None:
+            logger.info("Closing Omada circuit")
+            self._opened_at = None
+            self._set_state(CircuitState.CLOSED)
+
+    def failure(self) -> None:
+        """Record a failed request."""
+        self.failures += 1
+        if self.threshold is None or self.failures < self.threshold:
+            return
+        if self.state is not CircuitState.OPEN:
+            logger.warning("Opening Omada circuit", failures=self.failures)
+        self._opened_at = time.monotonic()
+        self._set_state(CircuitState.OPEN)
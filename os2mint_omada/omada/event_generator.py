@@ -3,10 +3,13 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import random
+import time
+from collections.abc import Collection
 from contextlib import suppress
+from dataclasses import replace
 from enum import StrEnum
+from typing import Any
 from typing import AsyncContextManager
 from typing import Self
 from uuid import UUID
@@ -18,9 +21,17 @@ from fastramqpi.ramqp import AMQPSystem
 from pydantic import parse_obj_as
 
 from os2mint_omada.config import OmadaSettings
+from os2mint_omada.omada.api import NotModified
 from os2mint_omada.omada.api import OmadaAPI
+from os2mint_omada.omada.api import ViewState
+from os2mint_omada.omada.api import delta_filter
 from os2mint_omada.omada.models import OmadaUser
 from os2mint_omada.omada.models import RawOmadaUser
+from os2mint_omada.omada.store import SavedUser
+from os2mint_omada.omada.store import SavedUsers
+from os2mint_omada.omada.store import UserStore
+from os2mint_omada.omada.store import create_store
+from os2mint_omada.omada.store import saved_user
 
 logger = structlog.stdlib.get_logger()
 
@@ -37,7 +48,11 @@ class Event(StrEnum):
 
 class OmadaEventGenerator(AsyncContextManager):
     def __init__(
-        self, settings: OmadaSettings, api: OmadaAPI, amqp_system: AMQPSystem
+        self,
+        settings: OmadaSettings,
+        api: OmadaAPI,
+        amqp_system: AMQPSystem,
+        store: UserStore | None = None,
     ) -> None:
         """Omada event generator.
 
@@ -49,13 +64,27 @@ class OmadaEventGenerator(AsyncContextManager):
             settings: Omada-specific settings.
             api: OmadaAPI instance.
             amqp_system: Omada AMQP system to send events to.
+            store: Store of the users retrieved the last time. Defaults to the store
+             configured by the settings.
         """
         self.settings = settings
         self.api = api
         self.amqp_system = amqp_system
+        self.store = store if store is not None else create_store(settings)
+        self._view = ViewState()
+        # Users and high-water mark of the store, kept in memory to avoid loading
+        # them in every cycle. Loaded on first use, i.e. at startup.
+        self._users: SavedUsers | None = None
+        self._high_water_mark: Any = None
 
     async def __aenter__(self) -> Self:
         """Start the scheduler task."""
+        if self.settings.mirror:
+            # Serve the mirror from the saved view until the first scan has completed.
+            # Its age is unknown, so it is never considered fresh by `snapshot_max_age`.
+            saved_users = await self._saved_users()
+            users = [raw_user for _, raw_user in saved_users.values()]
+            self.api.update_snapshot(users, timestamp=float("-inf"))
         logger.debug("Starting Omada event scheduler")
         self._scheduler_task: asyncio.Task = asyncio.create_task(self._scheduler())
         return self
@@ -71,11 +100,23 @@ class OmadaEventGenerator(AsyncContextManager):
 
     async def _scheduler(self) -> None:
         """The scheduler periodically and invokes the event generation logic."""
-        logger.info("Starting Omada scheduler", interval=self.settings.interval)
+        logger.info(
+            "Starting Omada scheduler",
+            interval=self.settings.interval,
+            delta_interval=self.settings.delta_interval,
+        )
         while True:
             try:
                 await self.generate()
-                await asyncio.sleep(self.settings.interval)
+                # Poll for changed users between full scans, which are still needed
+                # to detect deleted users.
+                next_full = time.monotonic() + self.settings.interval
+                delta_interval = self.settings.delta_interval
+                if self.settings.delta_attribute is not None:
+                    while next_full - time.monotonic() > delta_interval:
+                        await asyncio.sleep(delta_interval)
+                        await self.generate_delta()
+                await asyncio.sleep(max(next_full - time.monotonic(), 0))
             except asyncio.CancelledError:
                 logger.info("Stopping Omada scheduler")
                 raise
@@ -90,59 +131,167 @@ class OmadaEventGenerator(AsyncContextManager):
 
     async def generate(self) -> None:
         """Generate Omada events based on the live Omada API view and saved state."""
-        # Retrieve raw lists of users from the previous run and API
-        old_users_list = self._load_users()
-        new_users_list = await self.api.get_users()
+        # The view state is only committed once the cycle has completed successfully,
+        # so a failed cycle does not cause changes to be skipped in the next one.
+        view = replace(self._view)
+        timestamp = time.monotonic()
+        try:
+            new_users = await self._fetch_users(view, timestamp)
+        except NotModified:
+            logger.info("Omada view not modified")
+            self.api.touch_snapshot(timestamp)
+            dipex_last_success_timestamp.set_to_current_time()
+            return
+
+        old_users = await self._saved_users()
+        changed: Collection[UUID] = ()
+        if view.unchanged:
+            # Skip diffing; the saved state is identical to the view
+            logger.info("Omada view unchanged")
+        else:
+            changed = await self._publish_events(old_users, new_users)
+        high_water_mark = self._get_high_water_mark(new_users)
+        await self.store.save(new_users, changed, high_water_mark)
+        self._users = new_users
+        self._high_water_mark = high_water_mark
+        self._view = view
 
-        def by_identifier(raw_users: list[RawOmadaUser]) -> dict[UUID, OmadaUser]:
-            """Structure by user identifier to allow detecting changes in values."""
-            users = parse_obj_as(list[OmadaUser], raw_users)
-            users_by_uid = {u.uid: u for u in users}
-            return users_by_uid
+        dipex_last_success_timestamp.set_to_current_time()
 
-        old_users = by_identifier(old_users_list)
-        new_users = by_identifier(new_users_list)
+    async def _fetch_users(self, view: ViewState, timestamp: float) -> SavedUsers:
+        """Retrieve all users from the API.
 
-        # Generate event for each user
+        Args:
+            view: State of the previous retrieval of the view, updated in-place.
+            timestamp: Monotonic time at which the retrieval was started.
+
+        Returns: The users, keyed by UId.
+        """
+        users = {}
+        async for raw_user in self.api.iter_users(view=view):
+            uid, saved = saved_user(jsonable_encoder(raw_user))
+            users[uid] = saved
+        if self.settings.snapshot_max_age is not None or self.settings.mirror:
+            self.api.update_snapshot(
+                [raw_user for _, raw_user in users.values()], timestamp
+            )
+        return users
+
+    async def _publish_events(
+        self, old_users: SavedUsers, new_users: SavedUsers
+    ) -> list[UUID]:
+        """Publish events for the differences between the saved and new users.
+
+        Users are compared by digest, and only parsed if they have changed.
+
+        Returns: UIds of the users which were added, changed or deleted.
+        """
+        changed = []
         for uid in old_users.keys() | new_users.keys():
             old = old_users.get(uid)
             new = new_users.get(uid)
-            # Skip if user is unchanged
-            if new == old:
+            if old is not None and new is not None and old[0] == new[0]:
                 continue
-            # Otherwise, determine change type
-            if old is None:
-                event = Event.CREATE
-                payload = new
-            elif new is None:
-                event = Event.DELETE
-                payload = old
-            else:
-                event = Event.UPDATE
-                payload = new
-            # Publish to AMQP
-            logger.info("Detected Omada event", change=event, uid=uid)
-            assert payload is not None  # mypy is so dumb
-            await self.amqp_system.publish_message(
-                routing_key=event,
-                payload=jsonable_encoder(payload),
-            )
+            changed.append(uid)
+            await self._publish_event(self._parse(old), self._parse(new))
+        logger.info("Compared Omada users", num_changed=len(changed))
+        return changed
+
+    async def _saved_users(self) -> SavedUsers:
+        """Return the saved users, loading them from the store if not in memory."""
+        if self._users is None:
+            self._users, self._high_water_mark = await self.store.load()
+        return self._users
+
+    def _parse(self, saved: SavedUser | None) -> OmadaUser | None:
+        """Parse the selected attributes of a saved user."""
+        if saved is None:
+            return None
+        return parse_obj_as(OmadaUser, self._project(saved[1]))
+
+    async def _publish_event(
+        self, old: OmadaUser | None, new: OmadaUser | None
+    ) -> None:
+        """Publish event for the change of a single user, if any."""
+        # Skip if user is unchanged
+        if new == old:
+            return
+        # Otherwise, determine change type
+        if old is None:
+            event = Event.CREATE
+            payload = new
+        elif new is None:
+            event = Event.DELETE
+            payload = old
+        else:
+            event = Event.UPDATE
+            payload = new
+        # Ensure handlers don't retrieve stale data from the API's cache
+        self.api.invalidate(u.dict(by_alias=True) for u in (old, new) if u is not None)
+        # Publish to AMQP
+        assert payload is not None  # mypy is so dumb
+        logger.info("Detected Omada event", change=event, uid=payload.uid)
+        await self.amqp_system.publish_message(
+            routing_key=event,
+            payload=jsonable_encoder(payload),
+        )
+
+    async def generate_delta(self) -> None:
+        """Generate events for users changed since the last saved high-water mark.
+
+        Only users whose `delta_attribute` is at least the high-water mark are
+        retrieved, so deleted users are not detected until the next full scan.
+        """
+        attribute = self.settings.delta_attribute
+        assert attribute is not None
+        users = dict(await self._saved_users())
+        high_water_mark = self._high_water_mark
+        if high_water_mark is None:
+            logger.info("No Omada high-water mark; waiting for full scan")
+            return
+        # Users changed exactly at the mark are retrieved again, to avoid missing
+        # changes made in the same instant as the last one seen. They are unchanged,
+        # and therefore don't generate events.
+        omada_filter = delta_filter(attribute, high_water_mark)
+        changed_users = [u async for u in self.api.iter_users(omada_filter)]
+        logger.info("Retrieved changed Omada users", num_users=len(changed_users))
+
+        changed = []
+        for raw_user in changed_users:
+            uid, new = saved_user(jsonable_encoder(raw_user))
+            old = users.get(uid)
+            users[uid] = new
+            if old is None or old[0] != new[0]:
+                changed.append(uid)
+                await self._publish_event(self._parse(old), self._parse(new))
+
+        high_water_mark = self._get_high_water_mark(users)
+        await self.store.save(users, changed, high_water_mark)
+        self._users = users
+        self._high_water_mark = high_water_mark
+        snapshot = self.api.snapshot
+        if snapshot is not None:
+            # Keep the timestamp of the full scan, as deletes are not reflected
+            raw_users = [raw_user for _, raw_user in users.values()]
+            self.api.update_snapshot(raw_users, snapshot.timestamp)
 
-        self._save_users(new_users_list)
         dipex_last_success_timestamp.set_to_current_time()
 
-    def _save_users(self, users: list[RawOmadaUser]) -> None:
-        """Save known Omada users (dicts) to disk."""
-        logger.info("Saving known Omada users", num_users=len(users))
-        with self.settings.persistence_file.open("w") as file:
-            json.dump(jsonable_encoder(users), file)
+    def _get_high_water_mark(self, users: SavedUsers) -> Any:
+        """Return the highest value of the `delta_attribute` of the users, if any."""
+        attribute = self.settings.delta_attribute
+        if attribute is None:
+            return None
+        values = (raw_user.get(attribute) for _, raw_user in users.values())
+        return max((v for v in values if v is not None), default=None)
 
-    def _load_users(self) -> list[RawOmadaUser]:
-        """Load known Omada users (dicts) from disk."""
-        try:
-            with self.settings.persistence_file.open() as file:
-                users = json.load(file)
-        except FileNotFoundError:
-            users = []
-        logger.info("Loaded known Omada users", num_users=len(users))
-        return users
+    def _project(self, user: RawOmadaUser) -> RawOmadaUser:
+        """Project saved user onto the selected attributes.
+
+        Users saved before the attributes were restricted are projected, to avoid
+        detecting all of them as updated.
+        """
+        attributes = self.api.attributes
+        if attributes is None:
+            return user
+        return {k: v for k, v in user.items() if k in attributes}
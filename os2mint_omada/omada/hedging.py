@@ -0,0 +1,106 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable
+from collections.abc import Callable
+from typing import TypeVar
+
+import structlog
+
+from os2mint_omada.omada.metrics import omada_hedged_requests
+from os2mint_omada.omada.metrics import omada_hedged_wins
+
+logger = structlog.stdlib.get_logger()
+
+T = TypeVar("T")
+
+
+class Hedger:
+    def __init__(
+        self,
+        percentile: float,
+        max_ratio: float,
+        window: int = 1000,
+        min_samples: int = 20,
+    ) -> None:
+        """Hedge requests to cut the tail latency.
+
+        If a request has not completed within the given percentile of recent request
+        latencies, a duplicate request is sent, and whichever completes first is used.
+        At most `max_ratio` of recent requests are hedged, so a generally slow Omada is
+        not met with twice the load.
+
+        Args:
+            percentile: Percentile of recent latencies to wait before hedging.
+            max_ratio: Maximum fraction of recent requests which may be hedged.
+            window: Number of recent requests to base the delay and ratio on.
+            min_samples: Number of latencies required before any hedging is done.
+        """
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._hedged: deque[bool] = deque(maxlen=window)
+
+    @property
+    def delay(self) -> float | None:
+        """Delay before hedging, or None if there are too few samples."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[round(self.percentile / 100 * (len(latencies) - 1))]
+
+    def _may_hedge(self) -> bool:
+        return sum(self._hedged) < self.max_ratio * len(self._hedged)
+
+    async def _timed(self, request: Callable[[], Awaitable[T]]) -> T:
+        start = time.monotonic()
+        result = await request()
+        self._latencies.append(time.monotonic() - start)
+        return result
+
+    async def run(self, request: Callable[[], Awaitable[T]]) -> T:
+        """Run request, hedging it if it is slow.
+
+        Args:
+            request: Function which makes the request. Must be idempotent.
+
+        Returns: Result of the first request to complete successfully.
+        """
+        delay = self.delay
+        primary = asyncio.create_task(self._timed(request))
+        if delay is None:
+            self._hedged.append(False)
+            return await primary
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done or not self._may_hedge():
+                self._hedged.append(False)
+                return await primary
+
+            logger.debug("Hedging slow Omada request", delay=delay)
+            omada_hedged_requests.inc()
+            self._hedged.append(True)
+            hedge = asyncio.create_task(self._timed(request))
+            try:
+                pending = {primary, hedge}
+                while True:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        if task.exception() is None:
+                            if task is hedge:
+                                omada_hedged_wins.inc()
+                            return task.result()
+                    # Only fail if both requests failed
+                    if not pending:
+                        return primary.result()
+            finally:
+                hedge.cancel()
+        finally:
+            primary.cancel()
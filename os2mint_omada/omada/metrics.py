@@ -0,0 +1,75 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+# Metrics are registered in the default registry, which is exposed by FastRAMQPI.
+omada_coalesced_requests = Counter(
+    name="omada_coalesced_requests",
+    documentation="Omada API requests saved by sharing an identical in-flight request.",
+)
+omada_cache_hits = Counter(
+    name="omada_cache_hits",
+    documentation="Omada API requests answered from the cache.",
+)
+omada_cache_misses = Counter(
+    name="omada_cache_misses",
+    documentation="Omada API requests not found in the cache.",
+)
+# Labelled by request kind; see `api.request_kind`
+omada_received_bytes = Counter(
+    name="omada_received_bytes",
+    documentation="Bytes received from the Omada API, i.e. compressed.",
+    labelnames=["kind"],
+)
+omada_decoded_bytes = Counter(
+    name="omada_decoded_bytes",
+    documentation="Bytes received from the Omada API after decompression.",
+    labelnames=["kind"],
+)
+omada_pool_wait_seconds = Histogram(
+    name="omada_pool_wait_seconds",
+    documentation="Time Omada API requests wait for a connection from the pool.",
+)
+omada_circuit_state = Gauge(
+    name="omada_circuit_state",
+    documentation="State of the Omada API circuit: 0=closed, 1=half-open, 2=open.",
+)
+omada_rate_limit_wait_seconds = Histogram(
+    name="omada_rate_limit_wait_seconds",
+    documentation="Time Omada API requests wait in the client-side rate limiter.",
+    labelnames=["priority"],
+)
+omada_hedged_requests = Counter(
+    name="omada_hedged_requests",
+    documentation="Duplicate Omada API requests sent because the original was slow.",
+)
+omada_hedged_wins = Counter(
+    name="omada_hedged_wins",
+    documentation="Hedged Omada API requests which completed before the original.",
+)
+omada_view_retrieval_seconds = Histogram(
+    name="omada_view_retrieval_seconds",
+    documentation="Time to retrieve an entire Omada view, when merging several.",
+    labelnames=["view"],
+)
+# Per-request metrics, labelled by request kind and HTTP status code
+omada_request_duration_seconds = Histogram(
+    name="omada_request_duration_seconds",
+    documentation="Duration of Omada API requests, including the response body.",
+    labelnames=["kind", "status"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+omada_response_size_bytes = Histogram(
+    name="omada_response_size_bytes",
+    documentation="Size of Omada API responses as transferred, i.e. compressed.",
+    labelnames=["kind", "status"],
+    buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9),
+)
+omada_response_users = Histogram(
+    name="omada_response_users",
+    documentation="Number of users returned by Omada API requests.",
+    labelnames=["kind", "status"],
+    buckets=(0, 1, 2, 5, 10, 100, 1000, 10000, 100000),
+)
@@ -53,3 +53,15 @@ class OmadaUser(BaseModel):
             start=self.valid_from,
             end=self.valid_to,
         )
+
+
+def field_aliases(*models: type[BaseModel]) -> list[str]:
+    """Return the (Omada) attribute names of the fields of the given models.
+
+    Args:
+        *models: Omada user models.
+
+    Returns: Deduplicated list of field aliases, in the order they are declared.
+    """
+    aliases = (field.alias for model in models for field in model.__fields__.values())
+    return list(dict.fromkeys(aliases))
@@ -0,0 +1,168 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from __future__ import annotations
+
+import json
+import re
+from enum import Enum
+from enum import auto
+from typing import Any
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _State(Enum):
+    START = auto()
+    KEY = auto()
+    COLON = auto()
+    VALUE = auto()
+    AFTER_VALUE = auto()
+    ITEM = auto()
+    AFTER_ITEM = auto()
+    END = auto()
+
+
+class ODataDecoder:
+    def __init__(self, key: str = "value") -> None:
+        """Incremental decoder for OData JSON responses.
+
+        OData responses are JSON objects of the form `{"value": [...], ...}`. The
+        decoder is fed the response body piece by piece, and returns the elements of
+        the `value` array as soon as they have been received in full. This avoids
+        holding the entire response in memory at once. All other top-level attributes,
+        such as `@odata.nextLink`, are collected in `metadata`.
+
+        Args:
+            key: Top-level key of the array to decode incrementally.
+        """
+        self.key = key
+        self.metadata: dict[str, Any] = {}
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._state = _State.START
+        self._current_key: str | None = None
+        self._found = False
+        self._closed = False
+
+    def feed(self, data: str) -> list[Any]:
+        """Feed a piece of the response body to the decoder.
+
+        Args:
+            data: Next piece of the response body.
+
+        Returns: List of array elements completed by this piece.
+        """
+        self._buffer = self._buffer[self._pos :] + data
+        self._pos = 0
+        items: list[Any] = []
+        while self._state is not _State.END and self._step(items):
+            pass
+        return items
+
+    def close(self) -> list[Any]:
+        """Signal the end of the response body.
+
+        Returns: List of remaining array elements.
+        """
+        self._closed = True
+        items = self.feed("")
+        if self._state is not _State.END:
+            raise ValueError("Truncated OData response")
+        if not self._found:
+            raise ValueError(f"OData response has no {self.key!r} attribute")
+        return items
+
+    def _peek(self) -> str | None:
+        """Skip whitespace and return the next character, if available."""
+        match = WHITESPACE.match(self._buffer, self._pos)
+        assert match is not None
+        self._pos = match.end()
+        if self._pos == len(self._buffer):
+            return None
+        return self._buffer[self._pos]
+
+    def _expect(self, char: str) -> None:
+        if self._buffer[self._pos] != char:
+            raise ValueError(
+                f"Invalid OData response: expected {char!r} at position {self._pos}"
+            )
+        self._pos += 1
+
+    def _decode(self) -> tuple[bool, Any]:
+        """Decode the next JSON value, if it has been received in full."""
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if self._closed:
+                raise
+            return False, None
+        # Numbers and literals cannot be known to be complete until the next character
+        # has been received.
+        if end == len(self._buffer) and not self._closed:
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _step(self, items: list[Any]) -> bool:
+        """Advance the state machine by one token.
+
+        Returns: Whether progress was made, i.e. False if more data is needed.
+        """
+        char = self._peek()
+        if char is None:
+            return False
+
+        match self._state:
+            case _State.START:
+                self._expect("{")
+                self._state = _State.KEY
+            case _State.KEY:
+                if char == "}":
+                    self._pos += 1
+                    self._state = _State.END
+                    return True
+                complete, self._current_key = self._decode()
+                if not complete:
+                    return False
+                self._state = _State.COLON
+            case _State.COLON:
+                self._expect(":")
+                self._state = _State.VALUE
+            case _State.VALUE:
+                if self._current_key == self.key:
+                    self._expect("[")
+                    self._found = True
+                    self._state = _State.ITEM
+                    return True
+                complete, value = self._decode()
+                if not complete:
+                    return False
+                assert self._current_key is not None
+                self.metadata[self._current_key] = value
+                self._state = _State.AFTER_VALUE
+            case _State.AFTER_VALUE:
+                if char == "}":
+                    self._pos += 1
+                    self._state = _State.END
+                    return True
+                self._expect(",")
+                self._state = _State.KEY
+            case _State.ITEM:
+                if char == "]":
+                    self._pos += 1
+                    self._state = _State.AFTER_VALUE
+                    return True
+                complete, item = self._decode()
+                if not complete:
+                    return False
+                items.append(item)
+                self._state = _State.AFTER_ITEM
+            case _State.AFTER_ITEM:
+                if char == "]":
+                    self._pos += 1
+                    self._state = _State.AFTER_VALUE
+                    return True
+                self._expect(",")
+                self._state = _State.ITEM
+        return True
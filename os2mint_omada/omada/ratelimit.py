@@ -0,0 +1,100 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from __future__ import annotations
+
+import asyncio
+import heapq
+import time
+from contextvars import ContextVar
+from enum import IntEnum
+from itertools import count
+
+from os2mint_omada.omada.metrics import omada_rate_limit_wait_seconds
+
+
+class Priority(IntEnum):
+    """Priority of Omada requests; lower values go first."""
+
+    # The event generator's periodic retrieval of the entire view
+    VIEW = 0
+    # Lookups for CREATE and DELETE events
+    HIGH = 1
+    NORMAL = 2
+    # Lookups for REFRESH events, e.g. from /sync/omada
+    LOW = 3
+
+
+# Priority of Omada requests made in the current context, i.e. by the current AMQP
+# handler. Set by the `current_omada_user` dependency.
+request_priority: ContextVar[Priority] = ContextVar(
+    "request_priority", default=Priority.NORMAL
+)
+
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: int) -> None:
+        """Token bucket rate limiter with priority classes.
+
+        Requests take a token from the bucket, which is refilled at `rate` tokens per
+        second up to `burst` tokens. When the bucket is empty, waiting requests are
+        granted tokens in order of priority, and in FIFO order within each priority.
+
+        Args:
+            rate: Sustained number of requests per second.
+            burst: Maximum number of requests which can be made at once.
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._waiters: list[tuple[Priority, int, asyncio.Future[None]]] = []
+        self._counter = count()
+        self._dispatcher: asyncio.Task | None = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: Priority) -> None:
+        """Wait until a request of the given priority may be made.
+
+        Args:
+            priority: Priority of the request.
+        """
+        start = time.monotonic()
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+        else:
+            future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._counter), future))
+            if self._dispatcher is None:
+                self._dispatcher = asyncio.create_task(self._dispatch())
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Return the token if it was granted just before the cancellation.
+                # Otherwise, the dispatcher skips the cancelled future.
+                if future.done() and not future.cancelled():
+                    self._tokens += 1
+                raise
+        omada_rate_limit_wait_seconds.labels(priority=priority.name).observe(
+            time.monotonic() - start
+        )
+
+    async def _dispatch(self) -> None:
+        """Grant tokens to waiting requests as the bucket is refilled."""
+        try:
+            while self._waiters:
+                self._refill()
+                if self._tokens < 1:
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+                    continue
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():
+                    continue
+                self._tokens -= 1
+                future.set_result(None)
+        finally:
+            self._dispatcher = None
@@ -0,0 +1,110 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from __future__ import annotations
+
+import re
+import time
+from collections import defaultdict
+from collections.abc import Hashable
+from collections.abc import Iterable
+from typing import Any
+
+from os2mint_omada.omada.models import RawOmadaUser
+
+# Customer-specific CPR-number attributes; see `sync/*/models.py`
+CPR_KEYS = {"C_CPRNR", "C_CPRNUMBER"}
+
+# Omada filter query `<key> eq <value>`, where strings are quoted; see `api.eq_filter`
+EQ_FILTER_REGEX = re.compile(r"(\w+) eq (?:(-?\d+)|'([^']*)')")
+
+
+def normalise(key: str, value: Any) -> Hashable:
+    """Normalise attribute value for indexing.
+
+    CPR numbers are stored both with and without dash, e.g. "xxxxxx-xxxx", so they are
+    indexed without, such that both variations are found in the same bucket.
+    """
+    if key in CPR_KEYS and isinstance(value, str):
+        return value.replace("-", "")
+    return value
+
+
+def parse_eq_filter(omada_filter: str) -> tuple[str, int | str] | None:
+    """Parse Omada equality filter query.
+
+    Args:
+        omada_filter: Filter query, e.g. `Id eq 1` or `C_CPRNR eq '0101011234'`.
+
+    Returns: Tuple of key and value, or None if the filter is not a single equality.
+    """
+    match = EQ_FILTER_REGEX.fullmatch(omada_filter)
+    if match is None:
+        return None
+    key, int_value, str_value = match.groups()
+    if int_value is not None:
+        return key, int(int_value)
+    return key, str_value
+
+
+class OmadaSnapshot:
+    keys = ("Id", "UId", *sorted(CPR_KEYS))
+
+    def __init__(self, users: Iterable[RawOmadaUser], timestamp: float) -> None:
+        """In-memory snapshot of the Omada view with hash indexes.
+
+        The most commonly used attributes are indexed up front. Indexes of other
+        attributes are built on first use.
+
+        Args:
+            users: Raw Omada users of the view.
+            timestamp: Monotonic time at which the view was retrieved.
+        """
+        self.timestamp = timestamp
+        self.users = list(users)
+        self._indexes: dict[str, defaultdict[Hashable, list[RawOmadaUser]]] = {}
+        for key in self.keys:
+            self._index(key)
+
+    @property
+    def age(self) -> float:
+        """Number of seconds since the view was retrieved."""
+        return time.monotonic() - self.timestamp
+
+    def _index(self, key: str) -> defaultdict[Hashable, list[RawOmadaUser]]:
+        """Return index of the attribute, building it if necessary."""
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = defaultdict(list)
+            for user in self.users:
+                value = user.get(key)
+                if isinstance(value, Hashable) and value is not None:
+                    index[normalise(key, value)].append(user)
+        return index
+
+    def lookup(self, key: str, value: Any) -> list[RawOmadaUser]:
+        """Find users by attribute value, like the Omada filter `<key> eq <value>`.
+
+        Args:
+            key: Attribute.
+            value: Attribute value.
+
+        Returns: List of raw omada users with the exact attribute value.
+        """
+        users = self._index(key).get(normalise(key, value), [])
+        return [u for u in users if u[key] == value]
+
+    def query(self, omada_filter: str | None) -> list[RawOmadaUser] | None:
+        """Answer Omada filter query, if supported.
+
+        Args:
+            omada_filter: Optional filter query. Only `<key> eq <value>` is supported.
+
+        Returns: List of raw omada users matching the filter, or None if the filter is
+         not supported.
+        """
+        if omada_filter is None:
+            return list(self.users)
+        parsed = parse_eq_filter(omada_filter)
+        if parsed is None:
+            return None
+        return self.lookup(*parsed)
@@ -0,0 +1,413 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import sqlite3
+from abc import ABC
+from abc import abstractmethod
+from collections.abc import Collection
+from contextlib import closing
+from itertools import compress
+from pathlib import Path
+from typing import Any
+from uuid import UUID
+
+import structlog
+from more_itertools import chunked
+from sqlalchemy import Column
+from sqlalchemy import LargeBinary
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import Text
+from sqlalchemy import delete
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from os2mint_omada.config import OmadaSettings
+from os2mint_omada.omada.models import RawOmadaUser
+
+logger = structlog.stdlib.get_logger()
+
+# Tables of the Postgres store, which are created by FastRAMQPI at startup
+database_metadata = MetaData()
+users_table = Table(
+    "omada_users",
+    database_metadata,
+    Column("uid", PG_UUID(as_uuid=True), primary_key=True),
+    Column("digest", LargeBinary, nullable=False),
+    Column("raw", JSONB, nullable=False),
+)
+state_table = Table(
+    "omada_state",
+    database_metadata,
+    Column("key", Text, primary_key=True),
+    Column("value", JSONB),
+)
+# Maximum number of rows written per statement by the Postgres store
+POSTGRES_CHUNK_SIZE = 1000
+
+# The compact persistence format is gzip-compressed, and thus starts with its magic
+GZIP_MAGIC = b"\x1f\x8b"
+COMPACT_FORMAT_VERSION = 1
+
+# Saved user, as a tuple of its digest and the raw user
+SavedUser = tuple[bytes, RawOmadaUser]
+SavedUsers = dict[UUID, SavedUser]
+
+
+def user_digest(user: RawOmadaUser) -> bytes:
+    """Digest of the canonical JSON representation of a raw Omada user.
+
+    Users with equal digests are equal, so they can be compared without parsing.
+    """
+    canonical = json.dumps(user, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).digest()
+
+
+def saved_user(user: RawOmadaUser) -> tuple[UUID, SavedUser]:
+    """Return the UId and saved user of a raw Omada user, without parsing it."""
+    return UUID(str(user["UId"])), (user_digest(user), user)
+
+
+class UserStore(ABC):
+    """Persistent store of the Omada users seen by the event generator."""
+
+    @abstractmethod
+    async def load(self) -> tuple[SavedUsers, Any]:
+        """Load the saved users and high-water mark.
+
+        Returns: Tuple of the saved users, keyed by UId, and the high-water mark.
+        """
+
+    @abstractmethod
+    async def save(
+        self, users: SavedUsers, changed: Collection[UUID], high_water_mark: Any
+    ) -> None:
+        """Save the users and high-water mark atomically.
+
+        Args:
+            users: All users, keyed by UId.
+            changed: UIds of the users which were added, changed or deleted since the
+             last save. Deleted users are not in `users`.
+            high_water_mark: High-water mark of the `delta_attribute`.
+        """
+
+
+class JSONUserStore(UserStore):
+    def __init__(self, path: Path, compact: bool = False) -> None:
+        """Store the users in a single file, which is rewritten on every save.
+
+        The file is either a JSON document, or, if `compact`, a gzip-compressed
+        stream of JSON lines: a header holding the attribute names of all users,
+        followed by one line per user with a bitmask of its attributes and their
+        values. Attribute names are thus only written once. Either format is
+        detected on load.
+
+        The file is written to a temporary file first, which then atomically replaces
+        the previous one.
+
+        Args:
+            path: Path of the file.
+            compact: Whether to save in the compact format.
+        """
+        self.path = path
+        self.compact = compact
+
+    @property
+    def _tmp_file(self) -> Path:
+        return self.path.with_name(f"{self.path.name}.tmp")
+
+    async def load(self) -> tuple[SavedUsers, Any]:
+        try:
+            with self.path.open("rb") as file:
+                compact = file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        except FileNotFoundError:
+            return {}, None
+        if compact:
+            raw_users, high_water_mark = self._load_compact()
+        else:
+            raw_users, high_water_mark = self._load_json()
+        logger.info("Loaded Omada users", path=str(self.path), num_users=len(raw_users))
+        users = dict(saved_user(u) for u in raw_users)
+        return users, high_water_mark
+
+    def _load_json(self) -> tuple[list[RawOmadaUser], Any]:
+        with self.path.open() as file:
+            state = json.load(file)
+        if isinstance(state, list):
+            # Saved before the high-water mark was introduced
+            return state, None
+        return state["users"], state.get("high_water_mark")
+
+    def _load_compact(self) -> tuple[list[RawOmadaUser], Any]:
+        with gzip.open(self.path, "rt", encoding="utf-8") as file:
+            header = json.loads(file.readline())
+            if header.get("version") != COMPACT_FORMAT_VERSION:
+                raise ValueError(f"Unsupported persistence format: {header}")
+            keys = header["keys"]
+            all_keys = (1 << len(keys)) - 1
+            users = []
+            for line in file:
+                mask, *values = json.loads(line)
+                if mask == all_keys:
+                    users.append(dict(zip(keys, values)))
+                    continue
+                present = ((mask >> i) & 1 for i in range(len(keys)))
+                users.append(dict(zip(compress(keys, present), values)))
+        return users, header["high_water_mark"]
+
+    async def save(
+        self, users: SavedUsers, changed: Collection[UUID], high_water_mark: Any
+    ) -> None:
+        tmp_file = self._tmp_file
+        try:
+            if self.compact:
+                self._save_compact(tmp_file, users, high_water_mark)
+            else:
+                self._save_json(tmp_file, users, high_water_mark)
+        except BaseException:
+            tmp_file.unlink(missing_ok=True)
+            raise
+        tmp_file.replace(self.path)
+        logger.info(
+            "Saved Omada users",
+            num_users=len(users),
+            high_water_mark=high_water_mark,
+        )
+
+    @staticmethod
+    def _save_json(path: Path, users: SavedUsers, high_water_mark: Any) -> None:
+        with path.open("w") as file:
+            file.write('{"users": [')
+            for i, (_, raw_user) in enumerate(users.values()):
+                if i:
+                    file.write(",")
+                json.dump(raw_user, file)
+            file.write(f'], "high_water_mark": {json.dumps(high_water_mark)}}}')
+
+    @staticmethod
+    def _save_compact(path: Path, users: SavedUsers, high_water_mark: Any) -> None:
+        keys = list(
+            dict.fromkeys(k for _, raw_user in users.values() for k in raw_user)
+        )
+        index = {k: i for i, k in enumerate(keys)}
+        header = {
+            "version": COMPACT_FORMAT_VERSION,
+            "keys": keys,
+            "high_water_mark": high_water_mark,
+        }
+        with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as file:
+            file.write(json.dumps(header) + "\n")
+            for _, raw_user in users.values():
+                # Values are written in the order of the keys, whichever order the
+                # user's attributes are in.
+                row = sorted((index[k], v) for k, v in raw_user.items())
+                mask = sum(1 << i for i, _ in row)
+                file.write(json.dumps([mask, *(v for _, v in row)]) + "\n")
+
+
+class SQLiteUserStore(UserStore):
+    def __init__(self, path: Path, json_path: Path | None = None) -> None:
+        """Store the users in an SQLite database, with one row per user.
+
+        Only added, changed and deleted users are written on save, in a single
+        transaction. If the database has not been migrated, the users of the JSON
+        persistence file, if any, are imported on the first load.
+
+        Args:
+            path: Path of the SQLite database.
+            json_path: Optional path of the JSON persistence file to migrate from.
+        """
+        self.path = path
+        self.json_path = json_path
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "uid TEXT PRIMARY KEY, digest BLOB NOT NULL, raw TEXT NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        return connection
+
+    async def load(self) -> tuple[SavedUsers, Any]:
+        with closing(self._connect()) as connection:
+            state = dict(connection.execute("SELECT key, value FROM state"))
+            if "migrated" not in state:
+                await self._migrate(connection)
+                state = dict(connection.execute("SELECT key, value FROM state"))
+            rows = connection.execute(
+                "SELECT uid, digest, raw FROM users ORDER BY rowid"
+            )
+            users = {UUID(uid): (digest, json.loads(raw)) for uid, digest, raw in rows}
+        logger.info("Loaded Omada users", path=str(self.path), num_users=len(users))
+        return users, json.loads(state.get("high_water_mark") or "null")
+
+    async def _migrate(self, connection: sqlite3.Connection) -> None:
+        """Import the users of the JSON persistence file, if it exists."""
+        with connection:
+            if self.json_path is not None and self.json_path.exists():
+                logger.info("Migrating Omada users", path=str(self.json_path))
+                users, high_water_mark = await JSONUserStore(self.json_path).load()
+                self._write(connection, users, users.keys(), high_water_mark)
+            connection.execute(
+                "INSERT INTO state (key, value) VALUES ('migrated', 'true')"
+            )
+
+    async def save(
+        self, users: SavedUsers, changed: Collection[UUID], high_water_mark: Any
+    ) -> None:
+        with closing(self._connect()) as connection, connection:
+            self._write(connection, users, changed, high_water_mark)
+        logger.info(
+            "Saved Omada users",
+            num_changed=len(changed),
+            high_water_mark=high_water_mark,
+        )
+
+    @staticmethod
+    def _write(
+        connection: sqlite3.Connection,
+        users: SavedUsers,
+        changed: Collection[UUID],
+        high_water_mark: Any,
+    ) -> None:
+        """Write the changed users and high-water mark, within a transaction."""
+        connection.executemany(
+            "INSERT INTO users (uid, digest, raw) VALUES (?, ?, ?) "
+            "ON CONFLICT (uid) DO UPDATE "
+            "SET digest = excluded.digest, raw = excluded.raw",
+            (
+                (str(uid), users[uid][0], json.dumps(users[uid][1]))
+                for uid in changed
+                if uid in users
+            ),
+        )
+        connection.executemany(
+            "DELETE FROM users WHERE uid = ?",
+            ((str(uid),) for uid in changed if uid not in users),
+        )
+        connection.execute(
+            "INSERT INTO state (key, value) VALUES ('high_water_mark', ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (json.dumps(high_water_mark),),
+        )
+
+
+class PostgresUserStore(UserStore):
+    def __init__(
+        self, sessionmaker: async_sessionmaker, json_path: Path | None = None
+    ) -> None:
+        """Store the users in the FastRAMQPI Postgres database, one row per user.
+
+        Only added, changed and deleted users are written on save, using bulk upserts
+        and deletes in a single transaction. If the database has not been migrated,
+        the users of the JSON persistence file, if any, are imported on the first
+        load. The tables must be created by passing `database_metadata` to FastRAMQPI.
+
+        Args:
+            sessionmaker: FastRAMQPI database sessionmaker.
+            json_path: Optional path of the JSON persistence file to migrate from.
+        """
+        self.sessionmaker = sessionmaker
+        self.json_path = json_path
+
+    async def load(self) -> tuple[SavedUsers, Any]:
+        async with self.sessionmaker() as session, session.begin():
+            state = dict((await session.execute(select(state_table))).tuples().all())
+            if "migrated" not in state:
+                users: SavedUsers = {}
+                high_water_mark = None
+                if self.json_path is not None and self.json_path.exists():
+                    logger.info("Migrating Omada users", path=str(self.json_path))
+                    json_store = JSONUserStore(self.json_path)
+                    users, high_water_mark = await json_store.load()
+                await self._write(session, users, users.keys(), high_water_mark)
+                await session.execute(
+                    insert(state_table).values(key="migrated", value=True)
+                )
+                state["high_water_mark"] = high_water_mark
+            rows = await session.execute(select(users_table))
+            users = {uid: (digest, raw) for uid, digest, raw in rows.tuples()}
+        logger.info("Loaded Omada users", num_users=len(users))
+        return users, state.get("high_water_mark")
+
+    async def save(
+        self, users: SavedUsers, changed: Collection[UUID], high_water_mark: Any
+    ) -> None:
+        async with self.sessionmaker() as session, session.begin():
+            await self._write(session, users, changed, high_water_mark)
+        logger.info(
+            "Saved Omada users",
+            num_changed=len(changed),
+            high_water_mark=high_water_mark,
+        )
+
+    @staticmethod
+    async def _write(
+        session: AsyncSession,
+        users: SavedUsers,
+        changed: Collection[UUID],
+        high_water_mark: Any,
+    ) -> None:
+        """Write the changed users and high-water mark, within a transaction."""
+        upserted = [
+            {"uid": uid, "digest": users[uid][0], "raw": users[uid][1]}
+            for uid in changed
+            if uid in users
+        ]
+        deleted = [uid for uid in changed if uid not in users]
+        upsert = insert(users_table)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[users_table.c.uid],
+            set_={"digest": upsert.excluded.digest, "raw": upsert.excluded.raw},
+        )
+        for rows in chunked(upserted, POSTGRES_CHUNK_SIZE):
+            await session.execute(upsert, rows)
+        for uids in chunked(deleted, POSTGRES_CHUNK_SIZE):
+            await session.execute(
+                delete(users_table).where(users_table.c.uid.in_(uids))
+            )
+        upsert_state = insert(state_table).values(
+            key="high_water_mark", value=high_water_mark
+        )
+        await session.execute(
+            upsert_state.on_conflict_do_update(
+                index_elements=[state_table.c.key],
+                set_={"value": upsert_state.excluded.value},
+            )
+        )
+
+
+def create_store(
+    settings: OmadaSettings, sessionmaker: async_sessionmaker | None = None
+) -> UserStore:
+    """Create the user store configured by the settings.
+
+    Args:
+        settings: Omada-specific settings.
+        sessionmaker: FastRAMQPI database sessionmaker, required by the Postgres store.
+
+    Returns: The user store.
+    """
+    persistence_file = settings.persistence_file
+    if settings.store == "postgres":
+        if sessionmaker is None:
+            raise ValueError("The Postgres store requires the FastRAMQPI database")
+        return PostgresUserStore(sessionmaker, json_path=persistence_file)
+    if settings.store == "sqlite":
+        return SQLiteUserStore(
+            persistence_file.with_suffix(".sqlite3"), json_path=persistence_file
+        )
+    return JSONUserStore(
+        persistence_file, compact=settings.persistence_format == "compact"
+    )
@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+"""Benchmark the persistence file formats of the event generator.
+
+Saves and loads a synthetic view, shaped like the Silkeborg schema, using each
+format, and prints the file size and timings. Run from the repository root:
+
+    python -m scripts.benchmark_persistence --users 10000
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from random import Random
+from uuid import UUID
+
+from os2mint_omada.omada.store import JSONUserStore
+from os2mint_omada.omada.store import SavedUsers
+from os2mint_omada.omada.store import saved_user
+
+
+def make_users(num_users: int, seed: int = 0) -> SavedUsers:
+    """Generate a synthetic view of raw Omada users."""
+    random = Random(seed)
+    users = []
+    for i in range(num_users):
+        first_name = random.choice(["Mia", "Emil", "Sofie", "Noah", "Ida", "Oscar"])
+        last_name = random.choice(["Hansen", "Jensen", "Nielsen", "Pedersen"])
+        users.append(
+            {
+                "Id": 1_000_000 + i,
+                "UId": str(UUID(int=random.getrandbits(128), version=4)),
+                "VALIDFROM": "2012-08-27T00:00:00+02:00",
+                "VALIDTO": "9999-12-31T01:00:00+01:00",
+                "C_TJENESTENR": f"v{i}",
+                "C_OBJECTGUID_I_AD": str(UUID(int=random.getrandbits(128), version=4)),
+                "C_LOGIN": f"DRV{i}",
+                "EMAIL": f"{first_name}.{last_name}{i}@silkeborg.dk",
+                "C_DIREKTE_TLF": "",
+                "CELLPHONE": f"+45 {random.randrange(10**8):08}",
+                "C_FORNAVNE": first_name,
+                "LASTNAME": last_name,
+                "C_CPRNR": f"{random.randrange(10**10):010}",
+                "JOBTITLE": random.choice(["Revisor", "Pædagog", "Sygeplejerske"]),
+                "C_ORGANISATIONSKODE": str(
+                    UUID(int=random.getrandbits(128), version=4)
+                ),
+                "C_SYNLIG_I_OS2MO": random.random() < 0.9,
+                "C_OS2MO_ID": f"DK-{i}",
+            }
+        )
+    return dict(saved_user(u) for u in users)
+
+
+async def benchmark(users: SavedUsers, directory: Path, repeat: int) -> None:
+    print(f"{'format':<10}{'size (KiB)':>12}{'save (ms)':>12}{'load (ms)':>12}")
+    for compact in (False, True):
+        path = directory / f"omada-{compact}.json"
+        store = JSONUserStore(path, compact=compact)
+        save = load = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await store.save(users, users.keys(), None)
+            save = min(save, time.perf_counter() - start)
+            start = time.perf_counter()
+            loaded, _ = await store.load()
+            load = min(load, time.perf_counter() - start)
+            assert loaded == users
+        name = "compact" if compact else "json"
+        size = path.stat().st_size / 1024
+        print(f"{name:<10}{size:>12.0f}{save * 1000:>12.0f}{load * 1000:>12.0f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    users = make_users(args.users)
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(benchmark(users, Path(directory), args.repeat))
+
+
+if __name__ == "__main__":
+    main()
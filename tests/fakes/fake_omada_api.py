@@ -1,11 +1,13 @@
 # SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
 import json
-import re
+import time
 
 from fastapi import FastAPI
 from fastapi import Request
 
+from os2mint_omada.omada.snapshot import OmadaSnapshot
+
 
 def create_app(values: list | None = None) -> FastAPI:
     """This fake Omada API is used for both manual and integration tests."""
@@ -16,6 +18,8 @@ def create_app(values: list | None = None) -> FastAPI:
         with open("/odata.json") as f:
             omada_json: dict = json.load(f)
         values = omada_json["value"]
+    # The fake shares the query engine of the integration's mirror mode
+    snapshot = OmadaSnapshot(values, timestamp=time.monotonic())
 
     app = FastAPI()
 
@@ -24,21 +28,17 @@ def create_app(values: list | None = None) -> FastAPI:
         """Incredibly basic Omada OData implementation.
 
         All our queries to the Omada API are either filter-less, or contain exactly one
-        filter of the format `<field> eq '<value>'` or `Id eq <value>`.
+        filter of the format `<field> eq '<value>'` or `Id eq <value>`. The attributes
+        of the returned users can be restricted using `$select`.
         """
-        omada_filter = request.query_params.get("$filter")
-        if not omada_filter:
-            return {"value": values}
-        match = re.match(r"(.+) eq (?:(\d+)|'(.+)')", omada_filter)
-        assert match is not None
-        key, int_value, str_value = match.groups()
-        value: int | str
-        if int_value is not None:
-            value = int(int_value)
-        elif str_value is not None:
-            value = str_value
-        else:
+        omada_filter = request.query_params.get("$filter") or None
+        users = snapshot.query(omada_filter)
+        if users is None:
             raise ValueError(f"Unknown filter: {omada_filter}")
-        return {"value": [v for v in values if v[key] == value]}
+        select = request.query_params.get("$select")
+        if select:
+            keys = select.split(",")
+            users = [{k: v for k, v in u.items() if k in keys} for u in users]
+        return {"value": users}
 
     return app
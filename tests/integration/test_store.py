@@ -0,0 +1,45 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from uuid import uuid4
+
+import pytest
+from fastramqpi import database
+from fastramqpi.config import DatabaseSettings
+from pydantic import BaseSettings
+
+from os2mint_omada.omada.store import PostgresUserStore
+from os2mint_omada.omada.store import database_metadata
+from os2mint_omada.omada.store import saved_user
+
+
+class Settings(DatabaseSettings, BaseSettings):
+    class Config:
+        env_prefix = "FASTRAMQPI__DATABASE__"
+
+
+@pytest.mark.integration_test
+async def test_postgres_store() -> None:
+    """Test that added, changed and deleted users are saved in Postgres."""
+    database.run_upgrade(database_metadata)
+    settings = Settings()
+    engine = database.create_engine(
+        user=settings.user,
+        password=settings.password,
+        host=settings.host,
+        port=settings.port,
+        name=settings.name,
+    )
+    store = PostgresUserStore(database.create_sessionmaker(engine))
+    assert await store.load() == ({}, None)
+
+    a, b, c = ({"Id": i, "UId": str(uuid4())} for i in range(3))
+    users = dict(saved_user(u) for u in (a, b))
+    await store.save(users, users.keys(), "2024-01-01")
+    assert await store.load() == (users, "2024-01-01")
+
+    # B is changed, A is deleted and C is added
+    new_users = dict(saved_user(u) for u in ({**b, "Id": 99}, c))
+    changed = [*new_users.keys(), next(iter(users))]
+    await store.save(new_users, changed, "2024-01-02")
+    assert await store.load() == (new_users, "2024-01-02")
+    await engine.dispose()
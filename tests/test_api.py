@@ -0,0 +1,89 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from collections.abc import AsyncIterator
+from collections.abc import Iterator
+from unittest.mock import MagicMock
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from fastramqpi.depends import from_user_context
+
+from os2mint_omada import api
+
+
+@pytest.fixture
+def omada_api() -> MagicMock:
+    omada_api = MagicMock()
+    omada_api.query_mirror.return_value = None
+    return omada_api
+
+
+@pytest.fixture
+def client(omada_api: MagicMock) -> Iterator[TestClient]:
+    app = FastAPI()
+    app.include_router(api.router)
+    app.dependency_overrides[from_user_context("omada_api")] = lambda: omada_api
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.mark.parametrize("users", [[], [{"Id": 1}], [{"Id": 1}, {"Id": 2}]])
+def test_get_users(client: TestClient, omada_api: MagicMock, users: list) -> None:
+    """Test that users are streamed as a JSON list."""
+
+    async def iter_users(omada_filter: str | None) -> AsyncIterator[dict]:
+        assert omada_filter == "Id eq 1"
+        for user in users:
+            yield user
+
+    omada_api.iter_users = iter_users
+    response = client.get("/get-users", params={"omada_filter": "Id eq 1"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == users
+
+
+def test_get_users_mirror(client: TestClient, omada_api: MagicMock) -> None:
+    """Test that supported queries are answered from the mirror."""
+    omada_api.query_mirror.return_value = [{"Id": 1}]
+    response = client.get("/get-users", params={"omada_filter": "Id eq 1"})
+    assert response.status_code == 200
+    assert response.json() == [{"Id": 1}]
+    omada_api.query_mirror.assert_called_once_with("Id eq 1")
+    omada_api.iter_users.assert_not_called()
+
+
+def test_get_users_error_before_first_user(
+    client: TestClient, omada_api: MagicMock
+) -> None:
+    """Test that errors are raised before the response is started."""
+
+    async def iter_users(omada_filter: str | None) -> AsyncIterator[dict]:
+        raise ValueError("Omada is down")
+        yield  # pragma: no cover
+
+    omada_api.iter_users = iter_users
+    with pytest.raises(ValueError, match="Omada is down"):
+        client.get("/get-users")
+
+
+def test_get_users_error_after_first_user(
+    client: TestClient, omada_api: MagicMock
+) -> None:
+    """Test that the stream is closed if Omada fails mid-response."""
+    closed = False
+
+    async def iter_users(omada_filter: str | None) -> AsyncIterator[dict]:
+        nonlocal closed
+        try:
+            yield {"Id": 1}
+            raise ValueError("Omada is down")
+        finally:
+            closed = True
+
+    omada_api.iter_users = iter_users
+    # The error is raised from the response task group
+    with pytest.raises(Exception):
+        client.get("/get-users")
+    assert closed
@@ -1,11 +1,24 @@
 # SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+import asyncio
+import gzip
+import json
+import re
+import time
+from collections import Counter
+from collections.abc import Callable
 from typing import AsyncGenerator
+from unittest.mock import patch
 
 import pytest
 from fastramqpi.raclients.auth import AuthenticatedAsyncHTTPXClient
 from httpx import AsyncClient
+from httpx import HTTPStatusError
+from httpx import ReadTimeout
 from httpx import Request
+from httpx import Response
+from httpx import Timeout
+from prometheus_client import REGISTRY
 from pydantic import AnyHttpUrl
 from pydantic import parse_obj_as
 from respx import MockRouter
@@ -13,8 +26,19 @@ from respx import MockRouter
 from os2mint_omada.config import OmadaBasicAuthSettings
 from os2mint_omada.config import OmadaOIDCSettings
 from os2mint_omada.config import OmadaSettings
+from os2mint_omada.omada.api import NotModified
 from os2mint_omada.omada.api import OmadaAPI
+from os2mint_omada.omada.api import ViewState
 from os2mint_omada.omada.api import create_client
+from os2mint_omada.omada.api import id_range_filters
+from os2mint_omada.omada.api import or_batches
+from os2mint_omada.omada.api import or_filter
+from os2mint_omada.omada.api import partition_boundaries
+from os2mint_omada.omada.api import request_kind
+from os2mint_omada.omada.api import trace_pool_wait
+from os2mint_omada.omada.circuit import CircuitOpenError
+from os2mint_omada.omada.ratelimit import Priority
+from os2mint_omada.omada.ratelimit import request_priority
 
 
 async def test_create_client_oidc_auth(omada_settings: OmadaSettings) -> None:
@@ -47,12 +71,62 @@ async def test_create_client_basic_auth(omada_settings: OmadaSettings) -> None:
     assert request.headers["Authorization"] == "Basic QXp1cmVEaWFtb25kOmh1bnRlcjI="
 
 
+async def test_create_client_compression(omada_settings: OmadaSettings) -> None:
+    """Test that compressed responses are negotiated."""
+    client = create_client(omada_settings)
+    assert client.headers["Accept-Encoding"] == "gzip, deflate, br"
+
+
+async def test_create_client_pool(omada_settings: OmadaSettings) -> None:
+    """Test that timeouts and connection pool limits are configurable."""
+    omada_settings.timeout = 30
+    omada_settings.read_timeout = 120
+    omada_settings.max_connections = 10
+    omada_settings.keepalive_expiry = 60
+    client = create_client(omada_settings)
+    assert client.timeout == Timeout(30, read=120)
+    pool = client._transport._pool  # type: ignore[attr-defined]
+    assert pool._max_connections == 10
+    assert pool._keepalive_expiry == 60
+
+
+async def test_trace_pool_wait() -> None:
+    """Test that the pool wait ends at the first trace event."""
+
+    def sample() -> float:
+        return REGISTRY.get_sample_value("omada_pool_wait_seconds_count") or 0
+
+    before = sample()
+    request = Request("GET", "https://omada.example.com")
+    await trace_pool_wait(request)
+    trace = request.extensions["trace"]
+    await trace("connection.connect_tcp.started", {})
+    await trace("http11.send_request_headers.started", {})
+    assert sample() - before == 1
+
+
+@pytest.mark.parametrize(
+    "omada_filter,kind",
+    [
+        (None, "view"),
+        ("Id eq 1", "id"),
+        ("C_CPRNR eq '0101011234'", "cpr"),
+        ("C_CPRNUMBER eq '010101-1234'", "cpr"),
+        ("UId eq 'abc'", "other"),
+        ("Id ge 10 and Id lt 20", "view"),
+        ("Id lt 10", "view"),
+    ],
+)
+def test_request_kind(omada_filter: str | None, kind: str) -> None:
+    assert request_kind(omada_filter) == kind
+
+
 @pytest.fixture
 async def omada_api(omada_settings: OmadaSettings) -> AsyncGenerator[OmadaAPI, None]:
     """Omada API."""
     client = create_client(settings=omada_settings)
     async with client:
-        yield OmadaAPI(url=omada_settings.url, client=client)
+        yield OmadaAPI(settings=omada_settings, client=client)
 
 
 async def test_get_users(
@@ -72,6 +146,8 @@ async def test_get_users_by_filter(
     respx_mock: MockRouter,
 ) -> None:
     """Test that filtering parameters are sent properly."""
+    # Falls back to individual requests if $batch is unsupported
+    respx_mock.post(url__startswith="https://omada.example.com/$batch").respond(404)
     respx_mock.get(
         url=omada_settings.url, params={"$filter": "key eq 'value1'"}
     ).respond(json={"value": [1]})
@@ -79,3 +155,732 @@ async def test_get_users_by_filter(
         url=omada_settings.url, params={"$filter": "key eq 'value2'"}
     ).respond(json={"value": [2]})
     assert await omada_api.get_users_by("key", ["value1", "value2"]) == [1, 2]
+    assert omada_api.supports_batch is False
+
+
+async def test_get_users_by_snapshot(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that lookups are answered from a fresh snapshot."""
+    omada_settings.snapshot_max_age = 60
+    users = [{"Id": 1, "C_CPRNR": "0101011234"}, {"Id": 2, "C_CPRNR": "0202021234"}]
+    route = respx_mock.get(url=omada_settings.url).respond(json={"value": [users[0]]})
+
+    omada_api.update_snapshot(users, timestamp=time.monotonic())
+    assert await omada_api.get_users_by("C_CPRNR", ["0202021234"]) == [users[1]]
+    # Attributes which are not indexed are retrieved from the API
+    assert await omada_api.get_users_by("EMAIL", ["foo@example.com"]) == [users[0]]
+    assert route.call_count == 1
+
+    # Stale snapshots are not used
+    omada_api.update_snapshot(users, timestamp=time.monotonic() - 61)
+    assert await omada_api.get_users_by("Id", [1]) == [users[0]]
+    assert route.call_count == 2
+
+
+async def test_mirror(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that supported queries are answered from the mirror regardless of age."""
+    omada_settings.mirror = True
+    users = [{"Id": 1, "EMAIL": "a@example.com"}, {"Id": 2, "EMAIL": "b@example.com"}]
+    route = respx_mock.get(url=omada_settings.url).respond(json={"value": [users[0]]})
+
+    # Queries are sent to Omada until the mirror has been populated
+    assert await omada_api.get_users("Id eq 1") == [users[0]]
+    assert route.call_count == 1
+
+    omada_api.update_snapshot(users, timestamp=float("-inf"))
+    assert await omada_api.get_users("EMAIL eq 'b@example.com'") == [users[1]]
+    assert await omada_api.get_users() == users
+    assert await omada_api.get_users_by("Id", [1, 2, 3]) == users
+    assert route.call_count == 1
+
+    # Unsupported filters are sent to Omada
+    assert await omada_api.get_users("Id ge 1") == [users[0]]
+    assert route.call_count == 2
+
+
+async def test_get_users_cache(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that filtered results are cached until invalidated."""
+    omada_settings.cache_ttl = 60
+    user = {"Id": 1, "UId": "A", "C_CPRNR": "0101011234"}
+    route = respx_mock.get(url=omada_settings.url).respond(json={"value": [user]})
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(settings=omada_settings, client=client)
+
+        hits = REGISTRY.get_sample_value("omada_cache_hits_total")
+        assert await omada_api.get_users_by("C_CPRNR", ["0101011234"]) == [user]
+        assert await omada_api.get_users_by("C_CPRNR", ["0101011234"]) == [user]
+        assert await omada_api.get_users("EMAIL ne ''") == [user]
+        assert route.call_count == 2
+        assert REGISTRY.get_sample_value("omada_cache_hits_total") - hits == 1
+
+        # Unrelated changes only invalidate the non-equality filter
+        omada_api.invalidate([{"Id": 2, "UId": "b", "C_CPRNR": "0202021234"}])
+        assert await omada_api.get_users_by("C_CPRNR", ["0101011234"]) == [user]
+        assert await omada_api.get_users("EMAIL ne ''") == [user]
+        assert route.call_count == 3
+
+        # Changes to the user invalidate everything containing it
+        omada_api.invalidate([{"Id": 1, "UId": "a"}])
+        assert await omada_api.get_users_by("C_CPRNR", ["0101011234"]) == [user]
+        assert route.call_count == 4
+
+
+async def test_get_users_coalesced(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that concurrent identical requests are coalesced."""
+    route = respx_mock.get(url=omada_settings.url).respond(json={"value": [{"Id": 1}]})
+    before = REGISTRY.get_sample_value("omada_coalesced_requests_total")
+    results = await asyncio.gather(
+        omada_api.get_users_by("Id", [1]),
+        omada_api.get_users_by("Id", [1]),
+        omada_api.get_users_by("Id", [1]),
+    )
+    assert results == [[{"Id": 1}]] * 3
+    assert route.call_count == 1
+    after = REGISTRY.get_sample_value("omada_coalesced_requests_total")
+    assert after - before == 2
+
+    # The request is no longer shared once it has completed
+    await omada_api.get_users_by("Id", [1])
+    assert route.call_count == 2
+
+
+async def test_iter_users(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that users are streamed from the Omada response."""
+    omada_users = [{"Id": 1}, {"Id": 2}]
+    respx_mock.get(url=omada_settings.url).respond(
+        json={
+            "@odata.context": "https://omada.example.com/$metadata",
+            "value": omada_users,
+        }
+    )
+    assert [u async for u in omada_api.iter_users()] == omada_users
+
+
+async def test_iter_users_conditional(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that the view is requested conditionally using the saved validators."""
+    body = {"value": [{"Id": 1}]}
+    route = respx_mock.get(url=omada_settings.url)
+    route.return_value = Response(
+        200, json=body, headers={"ETag": '"1"', "Last-Modified": "yesterday"}
+    )
+    view = ViewState()
+    assert [u async for u in omada_api.iter_users(view=view)] == body["value"]
+    assert view.etag == '"1"'
+    assert view.last_modified == "yesterday"
+    assert view.digest is not None
+    assert not view.unchanged
+    assert "If-None-Match" not in route.calls.last.request.headers
+
+    route.return_value = Response(304)
+    with pytest.raises(NotModified):
+        [u async for u in omada_api.iter_users(view=view)]
+    request = route.calls.last.request
+    assert request.headers["If-None-Match"] == '"1"'
+    assert request.headers["If-Modified-Since"] == "yesterday"
+
+
+async def test_iter_users_unchanged_digest(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that an unchanged body is detected without validators."""
+    route = respx_mock.get(url=omada_settings.url)
+    route.respond(json={"value": [{"Id": 1}]})
+    view = ViewState()
+    [u async for u in omada_api.iter_users(view=view)]
+    assert not view.unchanged
+    [u async for u in omada_api.iter_users(view=view)]
+    assert view.unchanged
+    route.respond(json={"value": [{"Id": 2}]})
+    [u async for u in omada_api.iter_users(view=view)]
+    assert not view.unchanged
+
+
+async def test_iter_users_transfer_size(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that compressed and decompressed response sizes are counted."""
+    body = json.dumps({"value": [{"Id": i} for i in range(100)]}).encode()
+    compressed = gzip.compress(body)
+    respx_mock.get(url=omada_settings.url).respond(
+        content=compressed, headers={"Content-Encoding": "gzip"}
+    )
+
+    def sample(name: str) -> float:
+        return REGISTRY.get_sample_value(name, {"kind": "view"}) or 0
+
+    received = sample("omada_received_bytes_total")
+    decoded = sample("omada_decoded_bytes_total")
+    assert len([u async for u in omada_api.iter_users()]) == 100
+    assert sample("omada_received_bytes_total") - received == len(compressed)
+    assert sample("omada_decoded_bytes_total") - decoded == len(body)
+
+
+async def test_iter_users_spool(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that the view is spooled to disk and decoded from the spool file."""
+    omada_settings.spool = True
+    omada_users = [{"Id": i, "UId": f"user-{i}"} for i in range(100)]
+    route = respx_mock.get(url=omada_settings.url)
+    route.respond(json={"value": omada_users})
+    view = ViewState()
+    with patch("os2mint_omada.omada.api.SPOOL_CHUNK_SIZE", 7):
+        assert [u async for u in omada_api.iter_users(view=view)] == omada_users
+        assert [u async for u in omada_api.iter_users(view=view)] == omada_users
+    assert view.unchanged
+    # Lookups are not spooled, and the spool file is removed after use
+    route.respond(json={"value": omada_users[:1]})
+    assert await omada_api.get_users("Id eq 0") == omada_users[:1]
+    assert list(omada_settings.persistence_file.parent.iterdir()) == []
+
+
+async def test_iter_users_select(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that the selected attributes are requested."""
+    respx_mock.get(
+        url=omada_settings.url,
+        params={"$filter": "Id eq 1", "$select": "Id,UId"},
+    ).respond(json={"value": [{"Id": 1, "UId": "x"}]})
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(
+            settings=omada_settings, client=client, select=["Id", "UId"]
+        )
+        assert await omada_api.get_users_by("Id", [1]) == [{"Id": 1, "UId": "x"}]
+
+
+async def test_iter_users_next_link(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that server-driven paging is followed."""
+    respx_mock.get(url=omada_settings.url, params={"$skiptoken": "2"}).respond(
+        json={"value": [3]}
+    )
+    respx_mock.get(url=omada_settings.url).respond(
+        json={"value": [1, 2], "@odata.nextLink": f"{omada_settings.url}?$skiptoken=2"}
+    )
+    assert await omada_api.get_users() == [1, 2, 3]
+
+
+@pytest.fixture
+def paged_omada_api(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+) -> OmadaAPI:
+    """Omada API with client-side paging and no backoff delay."""
+    omada_settings.page_size = 2
+    omada_settings.page_concurrency = 2
+    omada_settings.retry_backoff = 0
+    return omada_api
+
+
+def paging(users: list, max_page_size: int | None = None) -> Callable:
+    """Fake Omada view which supports $top, $skip and $orderby=Id."""
+
+    def page(request: Request) -> Response:
+        params = request.url.params
+        assert params["$orderby"] == "Id"
+        top = int(params["$top"])
+        if max_page_size is not None:
+            top = min(top, max_page_size)
+        skip = int(params.get("$skip", 0))
+        return Response(200, json={"value": users[skip : skip + top]})
+
+    return page
+
+
+async def test_iter_users_client_paging(
+    paged_omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that pages are requested using $top and $skip."""
+    omada_users = [{"Id": i} for i in range(7)]
+    route = respx_mock.get(url__startswith=omada_settings.url).mock(
+        side_effect=paging(omada_users)
+    )
+    assert await paged_omada_api.get_users() == omada_users
+    skips = {c.request.url.params.get("$skip") for c in route.calls}
+    # 4 pages followed by an empty page. A page after that might be requested
+    # concurrently before the end of the view is known.
+    assert skips >= {None, "2", "4", "6", "8"}
+
+
+async def test_iter_users_client_paging_unsupported_top(
+    paged_omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that the entire view is accepted if the server ignores $top."""
+    omada_users = [{"Id": i} for i in range(3)]
+    route = respx_mock.get(url__startswith=omada_settings.url).respond(
+        json={"value": omada_users}
+    )
+    assert await paged_omada_api.get_users() == omada_users
+    assert route.call_count == 1
+
+
+async def test_iter_users_client_paging_unsupported_skip(
+    paged_omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that paging fails if the server ignores $skip."""
+    respx_mock.get(url__startswith=omada_settings.url).respond(
+        json={"value": [{"Id": 1}, {"Id": 2}]}
+    )
+    with pytest.raises(ValueError, match="does not support \\$skip"):
+        await paged_omada_api.get_users()
+
+
+async def test_iter_users_client_paging_max_page_size(
+    paged_omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that paging fails if the server truncates pages."""
+    omada_users = [{"Id": i} for i in range(7)]
+    respx_mock.get(url__startswith=omada_settings.url).mock(
+        side_effect=paging(omada_users, max_page_size=1)
+    )
+    with pytest.raises(ValueError, match="maximum page size"):
+        await paged_omada_api.get_users()
+
+
+async def test_iter_users_client_paging_short_last_page(
+    paged_omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that a short first page is not mistaken for a truncated page."""
+    omada_users = [{"Id": 1}]
+    respx_mock.get(url__startswith=omada_settings.url).mock(
+        side_effect=paging(omada_users)
+    )
+    assert await paged_omada_api.get_users() == omada_users
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        Response(503),
+        Response(429),
+        ReadTimeout("Omada is slow"),
+    ],
+)
+async def test_iter_users_retry_page(
+    paged_omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+    error: Response | Exception,
+) -> None:
+    """Test that a failed page is retried on its own."""
+    omada_users = [{"Id": i} for i in range(3)]
+    page = paging(omada_users)
+    calls: Counter[str] = Counter()
+
+    def flaky_page(request: Request) -> Response:
+        skip = request.url.params.get("$skip", "0")
+        calls[skip] += 1
+        if skip == "2" and calls[skip] == 1:
+            if isinstance(error, Exception):
+                raise error
+            return error
+        return page(request)
+
+    respx_mock.get(url__startswith=omada_settings.url).mock(side_effect=flaky_page)
+    assert await paged_omada_api.get_users() == omada_users
+    assert calls["0"] == 1
+    assert calls["2"] == 2
+
+
+async def test_iter_users_no_retry_client_error(
+    paged_omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that client errors, e.g. an invalid filter, are not retried."""
+    route = respx_mock.get(url__startswith=omada_settings.url).respond(400)
+    with pytest.raises(HTTPStatusError):
+        await paged_omada_api.get_users("invalid")
+    assert route.call_count == 1
+
+
+async def test_circuit_breaker(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that requests fail fast once the circuit is open."""
+    omada_settings.retry_backoff = 0
+    omada_settings.circuit_threshold = 2
+    route = respx_mock.get(url=omada_settings.url).respond(503)
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(settings=omada_settings, client=client)
+        # The circuit opens during the retries of the first request
+        with pytest.raises(HTTPStatusError):
+            await omada_api.get_users()
+        assert route.call_count == 2
+        assert REGISTRY.get_sample_value("omada_circuit_state") == 2
+        with pytest.raises(CircuitOpenError):
+            await omada_api.get_users()
+    assert route.call_count == 2
+
+
+async def test_circuit_breaker_snapshot(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that lookups are served from a stale snapshot while the circuit is open."""
+    omada_settings.snapshot_max_age = 60
+    omada_settings.circuit_threshold = 1
+    omada_settings.retries = 0
+    users = [{"Id": 1}, {"Id": 2}]
+    route = respx_mock.get(url__startswith=omada_settings.url).respond(503)
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(settings=omada_settings, client=client)
+        omada_api.update_snapshot(users, timestamp=time.monotonic() - 61)
+        with pytest.raises(HTTPStatusError):
+            await omada_api.get_users_by("Id", [2])
+        assert await omada_api.get_users_by("Id", [2]) == [users[1]]
+    assert route.call_count == 1
+
+
+async def test_rate_limit(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that requests wait in the rate limiter with the context's priority."""
+    omada_settings.rate_limit = 1000
+    respx_mock.get(url__startswith=omada_settings.url).respond(json={"value": []})
+
+    def sample(priority: str) -> float:
+        return (
+            REGISTRY.get_sample_value(
+                "omada_rate_limit_wait_seconds_count", {"priority": priority}
+            )
+            or 0
+        )
+
+    before = {p: sample(p) for p in ("VIEW", "HIGH")}
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(settings=omada_settings, client=client)
+        await omada_api.get_users()
+        token = request_priority.set(Priority.HIGH)
+        try:
+            await omada_api.get_users_by("Id", [1])
+        finally:
+            request_priority.reset(token)
+    assert sample("VIEW") - before["VIEW"] == 1
+    assert sample("HIGH") - before["HIGH"] == 1
+
+
+async def test_hedge_filtered_only(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that filtered requests are hedged, but the entire view is not."""
+    omada_settings.hedge_percentile = 95
+    respx_mock.get(url__startswith=omada_settings.url).respond(json={"value": []})
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(settings=omada_settings, client=client)
+        assert omada_api.hedger is not None
+        with patch.object(omada_api.hedger, "run", wraps=omada_api.hedger.run) as run:
+            await omada_api.get_users()
+            run.assert_not_called()
+            await omada_api.get_users_by("Id", [1])
+            run.assert_called_once()
+
+
+def test_or_batches() -> None:
+    """Test that values are packed into batches bounded by the filter length."""
+    assert or_filter("Id", [1, "a"]) == "Id eq 1 or Id eq 'a'"
+    # len(quote("Id eq 1")) == 11 and len(quote(" or ")) == 8
+    assert or_batches("Id", [1, 2, 3, 4, 5], max_length=30) == [[1, 2], [3, 4], [5]]
+    assert or_batches("Id", [1, 2], max_length=5) == [[1], [2]]
+
+
+@pytest.mark.parametrize("status,supported", [(200, True), (400, False), (503, False)])
+async def test_probe_or_filter(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+    status: int,
+    supported: bool,
+) -> None:
+    """Test that support for or-filters is probed at startup."""
+    route = respx_mock.get(
+        url=omada_settings.url, params={"$filter": "Id eq -1 or Id eq -2"}
+    ).respond(status, json={"value": []})
+    async with omada_api:
+        assert omada_api.supports_or is supported
+    assert route.call_count == 1
+
+
+async def test_get_users_by_or_filter(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that lookups are batched if or-filters are supported."""
+    omada_settings.or_filter = True
+    omada_settings.max_filter_length = 30
+    omada_settings.batch_size = None
+    route = respx_mock.get(url__startswith=omada_settings.url).respond(
+        json={"value": [{"Id": 1}]}
+    )
+    async with create_client(settings=omada_settings) as client:
+        async with OmadaAPI(settings=omada_settings, client=client) as omada_api:
+            users = await omada_api.get_users_by("Id", [1, 2, 3])
+    assert users == [{"Id": 1}, {"Id": 1}]
+    filters = sorted(c.request.url.params["$filter"] for c in route.calls)
+    assert filters == ["Id eq 1 or Id eq 2", "Id eq 3"]
+
+
+async def test_get_users_by_concurrency(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that the per-value fan-out is limited in concurrency."""
+    omada_settings.or_filter = False
+    omada_settings.lookup_concurrency = 2
+    omada_settings.batch_size = None
+    concurrent = max_concurrent = 0
+
+    async def slow(request: Request) -> Response:
+        nonlocal concurrent, max_concurrent
+        concurrent += 1
+        max_concurrent = max(max_concurrent, concurrent)
+        await asyncio.sleep(0.01)
+        concurrent -= 1
+        return Response(200, json={"value": []})
+
+    respx_mock.get(url__startswith=omada_settings.url).mock(side_effect=slow)
+    async with create_client(settings=omada_settings) as client:
+        async with OmadaAPI(settings=omada_settings, client=client) as omada_api:
+            await omada_api.get_users_by("Id", range(10))
+    assert max_concurrent == 2
+
+
+async def test_get_users_batch(
+    omada_api: OmadaAPI,
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that filters are sent in a single $batch request."""
+    response_body = (
+        b"--batchresponse_1\r\n"
+        b"Content-Type: application/http\r\n"
+        b"Content-Transfer-Encoding: binary\r\n"
+        b"\r\n"
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: application/json\r\n"
+        b"\r\n"
+        b'{"value": [{"Id": 1}]}\r\n'
+        b"--batchresponse_1\r\n"
+        b"Content-Type: application/http\r\n"
+        b"Content-Transfer-Encoding: binary\r\n"
+        b"\r\n"
+        b"HTTP/1.1 500 Internal Server Error\r\n"
+        b"\r\n"
+        b"\r\n"
+        b"--batchresponse_1--\r\n"
+    )
+    batch_route = respx_mock.post("https://omada.example.com/$batch").respond(
+        content=response_body,
+        headers={"Content-Type": "multipart/mixed; boundary=batchresponse_1"},
+    )
+    # The failed request is retried individually
+    get_route = respx_mock.get(
+        url=omada_settings.url, params={"$filter": "Id eq 2"}
+    ).respond(json={"value": [{"Id": 2}]})
+
+    users = await omada_api.get_users_batch(["Id eq 1", "Id eq 2"])
+    assert users == [[{"Id": 1}], [{"Id": 2}]]
+    assert omada_api.supports_batch is True
+    assert batch_route.call_count == 1
+    assert get_route.call_count == 1
+    request = batch_route.calls.last.request
+    assert request.headers["Content-Type"].startswith("multipart/mixed; boundary=")
+    assert (
+        b"GET https://omada.example.com/odata.json?%24filter=Id%20eq%201 HTTP/1.1"
+        in (request.content)
+    )
+
+
+def test_partitions() -> None:
+    """Test that the view is partitioned by the Id distribution."""
+    assert partition_boundaries([], 4) == []
+    assert partition_boundaries(range(1, 9), 4) == [3, 5, 7]
+    # Duplicate boundaries are removed
+    assert partition_boundaries([1, 1, 1, 2], 4) == [2]
+    assert id_range_filters([3, 5]) == [
+        "Id lt 3",
+        "Id ge 3 and Id lt 5",
+        "Id ge 5",
+    ]
+
+
+async def test_iter_users_partitioned(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that the view is retrieved in partitions based on the previous Ids."""
+    omada_settings.partitions = 3
+    omada_users = [{"Id": i} for i in range(1, 10)]
+
+    def partition(request: Request) -> Response:
+        omada_filter = request.url.params.get("$filter", "")
+        users = omada_users
+        for op, bound in re.findall(r"Id (ge|lt) (\d+)", omada_filter):
+            if op == "ge":
+                users = [u for u in users if u["Id"] >= int(bound)]
+            else:
+                users = [u for u in users if u["Id"] < int(bound)]
+        return Response(200, json={"value": users})
+
+    route = respx_mock.get(url__startswith=omada_settings.url).mock(
+        side_effect=partition
+    )
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(settings=omada_settings, client=client)
+        # The first retrieval has no Ids to partition by
+        assert await omada_api.get_users() == omada_users
+        assert route.call_count == 1
+        users = await omada_api.get_users()
+    assert sorted(users, key=lambda u: u["Id"]) == omada_users
+    filters = [c.request.url.params["$filter"] for c in route.calls[1:]]
+    assert sorted(filters) == ["Id ge 4 and Id lt 7", "Id ge 7", "Id lt 4"]
+
+
+async def test_iter_users_partition_failure(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that the retrieval fails if any partition fails."""
+    omada_settings.partitions = 2
+    omada_settings.retries = 0
+    respx_mock.get(url=omada_settings.url, params={"$filter": "Id ge 2"}).respond(400)
+    respx_mock.get(url__startswith=omada_settings.url).respond(
+        json={"value": [{"Id": 1}, {"Id": 2}]}
+    )
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(settings=omada_settings, client=client)
+        await omada_api.get_users()
+        with pytest.raises(HTTPStatusError):
+            await omada_api.get_users()
+
+
+async def test_iter_users_views(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that users of several views are merged by UId."""
+    respx_mock.get(url=omada_settings.url).respond(
+        json={"value": [{"UId": "A", "Id": 1}, {"UId": "B", "Id": 2}]}
+    )
+    respx_mock.get(url="https://omada.example.com/external").respond(
+        json={"value": [{"UId": "a", "Id": 99, "EMAIL": "a@example.com"}, {"Id": 3}]}
+    )
+    before = REGISTRY.get_sample_value(
+        "omada_view_retrieval_seconds_count", {"view": "external"}
+    )
+    async with create_client(settings=omada_settings) as client:
+        external = OmadaAPI(
+            settings=omada_settings,
+            client=client,
+            select=["UId", "Id", "EMAIL"],
+            url=parse_obj_as(AnyHttpUrl, "https://omada.example.com/external"),
+            name="external",
+        )
+        omada_api = OmadaAPI(
+            settings=omada_settings,
+            client=client,
+            select=["UId", "Id"],
+            views=[external],
+        )
+        assert external.circuit is omada_api.circuit
+        assert omada_api.attributes == {"UId", "Id", "EMAIL"}
+        users = [u async for u in omada_api.iter_users()]
+    # The main view takes precedence
+    assert users == [
+        {"UId": "A", "Id": 1, "EMAIL": "a@example.com"},
+        {"UId": "B", "Id": 2},
+        {"Id": 3},
+    ]
+    after = REGISTRY.get_sample_value(
+        "omada_view_retrieval_seconds_count", {"view": "external"}
+    )
+    assert after == (before or 0) + 1
+
+
+async def test_request_metrics(
+    omada_settings: OmadaSettings,
+    respx_mock: MockRouter,
+) -> None:
+    """Test that requests are instrumented by kind and status code."""
+    omada_settings.retries = 0
+    respx_mock.get(url=omada_settings.url, params={"$filter": "Id eq 1"}).respond(
+        json={"value": [{"Id": 1}]}
+    )
+    respx_mock.get(
+        url=omada_settings.url, params={"$filter": "C_CPRNR eq '0101011234'"}
+    ).respond(500)
+    respx_mock.get(url=omada_settings.url).mock(side_effect=ReadTimeout("timeout"))
+
+    def sample(name: str, kind: str, status: str) -> float:
+        labels = {"kind": kind, "status": status}
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    names = [
+        "omada_request_duration_seconds_count",
+        "omada_response_size_bytes_count",
+        "omada_response_users_sum",
+    ]
+    labels = [("id", "200"), ("cpr", "500"), ("view", "error")]
+    before = {(n, *lbl): sample(n, *lbl) for n in names for lbl in labels}
+
+    async with create_client(settings=omada_settings) as client:
+        omada_api = OmadaAPI(settings=omada_settings, client=client)
+        await omada_api.get_users_by("Id", [1])
+        with pytest.raises(HTTPStatusError):
+            await omada_api.get_users_by("C_CPRNR", ["0101011234"])
+        with pytest.raises(ReadTimeout):
+            await omada_api.get_users()
+
+    after = {(n, *lbl): sample(n, *lbl) for n in names for lbl in labels}
+    diff = {k: after[k] - before[k] for k in before}
+    assert diff[("omada_request_duration_seconds_count", "id", "200")] == 1
+    assert diff[("omada_response_size_bytes_count", "id", "200")] == 1
+    assert diff[("omada_response_users_sum", "id", "200")] == 1
+    assert diff[("omada_request_duration_seconds_count", "cpr", "500")] == 1
+    assert diff[("omada_request_duration_seconds_count", "view", "error")] == 1
@@ -0,0 +1,50 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+import pytest
+
+from os2mint_omada.omada.batch import BatchResponse
+from os2mint_omada.omada.batch import decode_batch
+from os2mint_omada.omada.batch import encode_batch
+
+
+def test_encode_batch() -> None:
+    body = encode_batch(["https://example.com/a?x=1"], boundary="b")
+    assert body == (
+        b"--b\r\n"
+        b"Content-Type: application/http\r\n"
+        b"Content-Transfer-Encoding: binary\r\n"
+        b"\r\n"
+        b"GET https://example.com/a?x=1 HTTP/1.1\r\n"
+        b"Accept: application/json\r\n"
+        b"\r\n"
+        b"--b--\r\n"
+    )
+
+
+def test_decode_batch() -> None:
+    body = (
+        b"preamble\r\n"
+        b"--b\r\n"
+        b"Content-Type: application/http\r\n"
+        b"\r\n"
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: application/json\r\n"
+        b"\r\n"
+        b'{"value": []}\r\n'
+        b"--b\r\n"
+        b"Content-Type: application/http\r\n"
+        b"\r\n"
+        b"HTTP/1.1 404 Not Found\r\n"
+        b"\r\n"
+        b"\r\n"
+        b"--b--\r\n"
+    )
+    assert decode_batch('multipart/mixed; boundary="b"', body) == [
+        BatchResponse(status_code=200, content=b'{"value": []}'),
+        BatchResponse(status_code=404, content=b""),
+    ]
+
+
+def test_decode_batch_invalid() -> None:
+    with pytest.raises(ValueError):
+        decode_batch("application/json", b"{}")
@@ -0,0 +1,48 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from unittest.mock import patch
+
+from os2mint_omada.omada.cache import OmadaCache
+
+
+def test_lru() -> None:
+    """Test that the least recently used entry is evicted."""
+    cache = OmadaCache(max_size=2, ttl=60)
+    cache.set("a", [{"Id": 1}], tags=(), generation=0, generational=False)
+    cache.set("b", [{"Id": 2}], tags=(), generation=0, generational=False)
+    assert cache.get("a") == [{"Id": 1}]
+    cache.set("c", [{"Id": 3}], tags=(), generation=0, generational=False)
+    assert cache.get("b") is None
+    assert cache.get("a") == [{"Id": 1}]
+    assert cache.get("c") == [{"Id": 3}]
+
+
+def test_ttl() -> None:
+    cache = OmadaCache(max_size=2, ttl=60)
+    with patch("time.monotonic", return_value=1000):
+        cache.set("a", [], tags=(), generation=0, generational=False)
+    with patch("time.monotonic", return_value=1059):
+        assert cache.get("a") == []
+    with patch("time.monotonic", return_value=1061):
+        assert cache.get("a") is None
+
+
+def test_invalidate() -> None:
+    """Test that tagged and generational entries are invalidated."""
+    cache = OmadaCache(max_size=10, ttl=60)
+    cache.set("a", [], tags=["x"], generation=0, generational=False)
+    cache.set("b", [], tags=["y"], generation=0, generational=False)
+    cache.set("c", [], tags=[], generation=0, generational=True)
+    cache.invalidate(["x"])
+    assert cache.get("a") is None
+    assert cache.get("b") == []
+    assert cache.get("c") is None
+
+
+def test_set_stale() -> None:
+    """Test that results requested before an invalidation are not cached."""
+    cache = OmadaCache(max_size=10, ttl=60)
+    generation = cache.generation
+    cache.invalidate(["x"])
+    cache.set("a", [], tags=["x"], generation=generation, generational=False)
+    assert cache.get("a") is None
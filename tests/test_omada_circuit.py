@@ -0,0 +1,52 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from unittest.mock import patch
+
+import pytest
+
+from os2mint_omada.omada.circuit import CircuitBreaker
+from os2mint_omada.omada.circuit import CircuitOpenError
+from os2mint_omada.omada.circuit import CircuitState
+
+
+def test_open_after_threshold() -> None:
+    """Test that the circuit opens after consecutive failures only."""
+    circuit = CircuitBreaker(threshold=2, reset_timeout=30)
+    circuit.failure()
+    circuit.success()
+    circuit.failure()
+    circuit.check()
+    assert circuit.state is CircuitState.CLOSED
+    circuit.failure()
+    assert circuit.state is CircuitState.OPEN
+    with pytest.raises(CircuitOpenError):
+        circuit.check()
+
+
+def test_probe() -> None:
+    """Test that a single probe is let through after the reset timeout."""
+    circuit = CircuitBreaker(threshold=1, reset_timeout=30)
+    with patch("time.monotonic", return_value=1000):
+        circuit.failure()
+    with patch("time.monotonic", return_value=1031):
+        circuit.check()
+        assert circuit.state is CircuitState.HALF_OPEN
+        # Concurrent requests still fail fast
+        with pytest.raises(CircuitOpenError):
+            circuit.check()
+        # A failed probe re-opens the circuit
+        circuit.failure()
+        assert circuit.state is CircuitState.OPEN
+    with patch("time.monotonic", return_value=1062):
+        circuit.check()
+    circuit.success()
+    assert circuit.state is CircuitState.CLOSED
+    circuit.check()
+
+
+def test_disabled() -> None:
+    circuit = CircuitBreaker(threshold=None, reset_timeout=30)
+    for _ in range(100):
+        circuit.failure()
+    circuit.check()
+    assert not circuit.is_open
@@ -1,15 +1,23 @@
 # SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
 # mypy: disable-error-code=assignment
+import json
+from collections.abc import AsyncIterator
 from datetime import datetime
+from unittest.mock import ANY
 from unittest.mock import AsyncMock
 from unittest.mock import MagicMock
 from unittest.mock import call
+from unittest.mock import patch
 from uuid import uuid4
 
+import pytest
 from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
 
 from os2mint_omada.config import OmadaSettings
+from os2mint_omada.omada.api import NotModified
+from os2mint_omada.omada.api import ViewState
 from os2mint_omada.omada.event_generator import Event
 from os2mint_omada.omada.event_generator import OmadaEventGenerator
 from os2mint_omada.omada.models import OmadaUser
@@ -38,15 +46,20 @@ async def test_generate(omada_settings: OmadaSettings):
     new_users = [new_a, new_b, new_d]  # C is deleted
 
     # The "API" returns the new users
+    async def iter_users(view: ViewState | None = None) -> AsyncIterator[OmadaUser]:
+        for user in new_users:
+            yield user
+
     api = MagicMock()
-    api.get_users = AsyncMock(return_value=new_users)
+    api.iter_users = iter_users
+    api.attributes = None
 
     amqp_system = AsyncMock()
     event_generator = OmadaEventGenerator(
         settings=omada_settings, api=api, amqp_system=amqp_system
     )
-    # Override loading from disk to "load" the old users
-    event_generator._load_users = MagicMock(return_value=old_users)
+    # Save the old users to disk
+    omada_settings.persistence_file.write_text(json.dumps(jsonable_encoder(old_users)))
 
     await event_generator.generate()
 
@@ -67,3 +80,295 @@ async def test_generate(omada_settings: OmadaSettings):
         ],
         any_order=True,
     )
+
+
+async def test_generate_keeps_users_in_memory(omada_settings: OmadaSettings):
+    """Test that the saved users are only loaded from disk in the first cycle."""
+    user_a = get_test_user(1)
+    user_b = get_test_user(2)
+    views = [[user_a], [user_a, user_b]]
+
+    async def iter_users(view: ViewState | None = None) -> AsyncIterator[OmadaUser]:
+        for user in views.pop(0):
+            yield user
+
+    api = MagicMock()
+    api.iter_users = iter_users
+    api.attributes = None
+    amqp_system = AsyncMock()
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    )
+    with patch.object(
+        event_generator.store, "load", wraps=event_generator.store.load
+    ) as load:
+        await event_generator.generate()
+        await event_generator.generate()
+    load.assert_awaited_once()
+    amqp_system.publish_message.assert_has_awaits(
+        calls=[
+            call(routing_key=Event.CREATE, payload=jsonable_encoder(user_a)),
+            call(routing_key=Event.CREATE, payload=jsonable_encoder(user_b)),
+        ],
+    )
+    assert amqp_system.publish_message.await_count == 2
+
+
+async def test_generate_parses_changed_users_only(omada_settings: OmadaSettings):
+    """Test that unchanged users are detected by digest, without being parsed."""
+    users = [get_test_user(i) for i in range(10)]
+    changed = users[3].copy(update=dict(id=99))
+
+    async def iter_users(view: ViewState | None = None) -> AsyncIterator[OmadaUser]:
+        for user in [*users[:3], changed, *users[4:]]:
+            yield user
+
+    api = MagicMock()
+    api.iter_users = iter_users
+    api.attributes = None
+    amqp_system = AsyncMock()
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    )
+    omada_settings.persistence_file.write_text(json.dumps(jsonable_encoder(users)))
+    with patch(
+        "os2mint_omada.omada.event_generator.parse_obj_as", wraps=parse_obj_as
+    ) as parse:
+        await event_generator.generate()
+    assert parse.call_count == 2
+    amqp_system.publish_message.assert_awaited_once_with(
+        routing_key=Event.UPDATE, payload=jsonable_encoder(changed)
+    )
+
+
+async def test_generate_select(omada_settings: OmadaSettings):
+    """Test that old users are projected onto the selected attributes."""
+    old_user = {
+        "Id": 1,
+        "UId": str(uuid4()),
+        "VALIDFROM": "2023-01-02T00:00:00",
+        "EMAIL": "foo@example.com",
+    }
+    new_user = {k: v for k, v in old_user.items() if k != "EMAIL"}
+
+    async def iter_users(view: ViewState | None = None) -> AsyncIterator[dict]:
+        yield new_user
+
+    api = MagicMock()
+    api.iter_users = iter_users
+    api.attributes = {"Id", "UId", "VALIDFROM", "VALIDTO"}
+
+    amqp_system = AsyncMock()
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    )
+    omada_settings.persistence_file.write_text(json.dumps([old_user]))
+
+    await event_generator.generate()
+
+    amqp_system.publish_message.assert_not_awaited()
+
+
+async def test_generate_not_modified(omada_settings: OmadaSettings):
+    """Test that the cycle is short-circuited if the view is not modified."""
+    old_users = [get_test_user(1)]
+    omada_settings.persistence_file.write_text(json.dumps(jsonable_encoder(old_users)))
+    views = []
+
+    async def iter_users(view: ViewState | None = None) -> AsyncIterator[dict]:
+        views.append(view)
+        raise NotModified()
+        yield  # pragma: no cover
+
+    api = MagicMock()
+    api.iter_users = iter_users
+
+    amqp_system = AsyncMock()
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    )
+    event_generator._view = ViewState(etag='"1"')
+
+    await event_generator.generate()
+
+    assert views == [ViewState(etag='"1"')]
+    api.touch_snapshot.assert_called_once()
+    amqp_system.publish_message.assert_not_awaited()
+    # The saved state is kept
+    assert json.loads(omada_settings.persistence_file.read_text()) == (
+        jsonable_encoder(old_users)
+    )
+    assert list(omada_settings.persistence_file.parent.iterdir()) == [
+        omada_settings.persistence_file
+    ]
+
+
+async def test_generate_unchanged(omada_settings: OmadaSettings):
+    """Test that users are not diffed if the content hash is unchanged."""
+    new_users = [get_test_user(1)]
+
+    async def iter_users(view: ViewState | None = None) -> AsyncIterator[OmadaUser]:
+        assert view is not None
+        view.digest = "abc"
+        view.unchanged = True
+        for user in new_users:
+            yield user
+
+    api = MagicMock()
+    api.iter_users = iter_users
+    api.attributes = None
+
+    amqp_system = AsyncMock()
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    )
+    event_generator._publish_events = AsyncMock()
+
+    await event_generator.generate()
+
+    event_generator._publish_events.assert_not_awaited()
+    assert event_generator._view == ViewState(digest="abc", unchanged=True)
+    assert json.loads(omada_settings.persistence_file.read_text()) == {
+        "users": jsonable_encoder(new_users),
+        "high_water_mark": None,
+    }
+
+
+async def test_generate_failure_keeps_view(omada_settings: OmadaSettings):
+    """Test that the view state is only committed after a successful cycle."""
+
+    async def iter_users(view: ViewState | None = None) -> AsyncIterator[OmadaUser]:
+        assert view is not None
+        view.etag = '"2"'
+        yield get_test_user(1)
+
+    api = MagicMock()
+    api.iter_users = iter_users
+    api.attributes = None
+
+    amqp_system = AsyncMock()
+    amqp_system.publish_message.side_effect = RuntimeError("AMQP is down")
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    )
+
+    with pytest.raises(RuntimeError):
+        await event_generator.generate()
+
+    assert event_generator._view == ViewState()
+    assert not omada_settings.persistence_file.exists()
+
+
+async def test_generate_delta(omada_settings: OmadaSettings):
+    """Test that changed users are retrieved from the high-water mark."""
+    omada_settings.delta_attribute = "CHANGED"
+    old_a = {"Id": 1, "UId": str(uuid4()), "VALIDFROM": "2023-01-02T00:00:00"}
+    old_b = {"Id": 2, "UId": str(uuid4()), "VALIDFROM": "2023-01-02T00:00:00"}
+    old_a["CHANGED"] = "2024-01-01T00:00:00Z"
+    old_b["CHANGED"] = "2024-01-02T00:00:00Z"
+    new_b = {**old_b, "Id": 99, "CHANGED": "2024-01-03T00:00:00Z"}
+    new_c = {"Id": 3, "UId": str(uuid4()), "VALIDFROM": "2023-01-02T00:00:00"}
+    new_c["CHANGED"] = "2024-01-03T00:00:00Z"
+
+    filters = []
+
+    async def iter_users(
+        omada_filter: str | None = None, view: ViewState | None = None
+    ) -> AsyncIterator[dict]:
+        filters.append(omada_filter)
+        if omada_filter is None:
+            for user in (old_a, old_b):
+                yield user
+        else:
+            for user in (new_b, new_c):
+                yield user
+
+    api = MagicMock()
+    api.iter_users = iter_users
+    api.attributes = None
+    api.snapshot = None
+
+    amqp_system = AsyncMock()
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    )
+    # The full scan saves the high-water mark
+    await event_generator.generate()
+    state = json.loads(omada_settings.persistence_file.read_text())
+    assert state["high_water_mark"] == "2024-01-02T00:00:00Z"
+
+    await event_generator.generate_delta()
+    assert filters == [None, "CHANGED ge 2024-01-02T00:00:00Z"]
+    amqp_system.publish_message.assert_has_awaits(
+        calls=[
+            call(routing_key=Event.CREATE, payload=ANY),
+            call(routing_key=Event.UPDATE, payload=ANY),
+        ],
+        any_order=True,
+    )
+    state = json.loads(omada_settings.persistence_file.read_text())
+    assert state == {
+        "users": [old_a, new_b, new_c],
+        "high_water_mark": "2024-01-03T00:00:00Z",
+    }
+
+
+async def test_generate_delta_no_high_water_mark(omada_settings: OmadaSettings):
+    """Test that nothing is polled before a full scan has saved a high-water mark."""
+    omada_settings.delta_attribute = "CHANGED"
+    omada_settings.persistence_file.write_text(json.dumps([]))
+    api = MagicMock()
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=AsyncMock()
+    )
+    await event_generator.generate_delta()
+    api.iter_users.assert_not_called()
+
+
+async def test_mirror_warm_start(omada_settings: OmadaSettings):
+    """Test that the mirror is served from the saved view at startup."""
+    omada_settings.mirror = True
+    users = jsonable_encoder([get_test_user(1), get_test_user(2)], by_alias=True)
+    omada_settings.persistence_file.write_text(json.dumps({"users": users}))
+    api = MagicMock()
+    api.attributes = None
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=AsyncMock()
+    )
+    async with event_generator:
+        api.update_snapshot.assert_called_once_with(users, timestamp=float("-inf"))
+
+
+async def test_generate_sqlite(omada_settings: OmadaSettings):
+    """Test that the event generator works with the SQLite store."""
+    omada_settings.store = "sqlite"
+    user_a = get_test_user(1)
+    user_b = get_test_user(2)
+    views = [[user_a, user_b], [user_b]]
+
+    async def iter_users(view: ViewState | None = None) -> AsyncIterator[OmadaUser]:
+        for user in views.pop(0):
+            yield user
+
+    api = MagicMock()
+    api.iter_users = iter_users
+    api.attributes = None
+    amqp_system = AsyncMock()
+    event_generator = OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    )
+    await event_generator.generate()
+    await event_generator.generate()
+    amqp_system.publish_message.assert_has_awaits(
+        calls=[
+            call(routing_key=Event.CREATE, payload=jsonable_encoder(user_a)),
+            call(routing_key=Event.CREATE, payload=jsonable_encoder(user_b)),
+            call(routing_key=Event.DELETE, payload=jsonable_encoder(user_a)),
+        ],
+        any_order=True,
+    )
+    # A restarted event generator loads the saved users from the database
+    users, _ = await OmadaEventGenerator(
+        settings=omada_settings, api=api, amqp_system=amqp_system
+    ).store.load()
+    assert [raw for _, raw in users.values()] == [jsonable_encoder(user_b)]
@@ -0,0 +1,97 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+import asyncio
+
+import pytest
+
+from os2mint_omada.omada.hedging import Hedger
+
+
+def warm(hedger: Hedger, latency: float = 0.01, n: int = 20) -> None:
+    """Record a number of fast requests."""
+    for _ in range(n):
+        hedger._latencies.append(latency)
+        hedger._hedged.append(False)
+
+
+async def test_no_samples() -> None:
+    """Test that nothing is hedged until enough latencies have been recorded."""
+    hedger = Hedger(percentile=90, max_ratio=1)
+    assert hedger.delay is None
+    calls = 0
+
+    async def request() -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return calls
+
+    assert await hedger.run(request) == 1
+    assert calls == 1
+
+
+async def test_delay() -> None:
+    hedger = Hedger(percentile=50, max_ratio=1, min_samples=3)
+    for latency in (3, 1, 2):
+        hedger._latencies.append(latency)
+    assert hedger.delay == 2
+
+
+async def test_hedge() -> None:
+    """Test that slow requests are hedged, and the first to complete is used."""
+    hedger = Hedger(percentile=90, max_ratio=0.5)
+    warm(hedger)
+    calls = 0
+
+    async def request() -> str:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(10)
+            return "primary"
+        return "hedge"
+
+    assert await asyncio.wait_for(hedger.run(request), timeout=1) == "hedge"
+    assert calls == 2
+
+
+async def test_hedge_failure() -> None:
+    """Test that a failed hedge does not fail the request."""
+    hedger = Hedger(percentile=90, max_ratio=0.5)
+    warm(hedger)
+    calls = 0
+
+    async def request() -> str:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(0.1)
+            return "primary"
+        raise ValueError("hedge failed")
+
+    assert await hedger.run(request) == "primary"
+
+    async def failing() -> str:
+        await asyncio.sleep(0.05)
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        await hedger.run(failing)
+
+
+async def test_max_ratio() -> None:
+    """Test that the rate of hedged requests is capped."""
+    hedger = Hedger(percentile=90, max_ratio=0.04)
+    warm(hedger)
+    calls = 0
+
+    async def request() -> None:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+
+    await hedger.run(request)
+    assert calls == 2
+    # 1 of 21 requests hedged already exceeds 4%
+    await hedger.run(request)
+    assert calls == 3
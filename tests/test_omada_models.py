@@ -3,6 +3,8 @@
 import pytest
 
 from os2mint_omada.omada.models import OmadaUser
+from os2mint_omada.omada.models import field_aliases
+from os2mint_omada.sync.silkeborg.models import ManualSilkeborgOmadaUser
 
 
 @pytest.fixture
@@ -38,3 +40,27 @@ def test_fix_pseudo_infinity(omada_user: dict) -> None:
     omada_user["VALIDTO"] = "9999-12-31T01:00:00+01:00"
     user = OmadaUser.parse_obj(omada_user)
     assert user.valid_to is None
+
+
+def test_field_aliases() -> None:
+    """Test that aliases are collected from all models without duplicates."""
+    assert field_aliases(OmadaUser, ManualSilkeborgOmadaUser) == [
+        "Id",
+        "UId",
+        "VALIDFROM",
+        "VALIDTO",
+        "C_CPRNR",
+        "C_TJENESTENR",
+        "C_OS2MO_ID",
+        "C_OBJECTGUID_I_AD",
+        "C_LOGIN",
+        "EMAIL",
+        "C_DIREKTE_TLF",
+        "CELLPHONE",
+        "C_INST_PHONE",
+        "C_FORNAVNE",
+        "LASTNAME",
+        "JOBTITLE",
+        "C_ORGANISATIONSKODE",
+        "C_SYNLIG_I_OS2MO",
+    ]
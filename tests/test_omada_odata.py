@@ -0,0 +1,63 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+import json
+
+import pytest
+
+from os2mint_omada.omada.odata import ODataDecoder
+
+RESPONSE = {
+    "@odata.context": "https://omada.example.com/$metadata#Identity",
+    "value": [
+        {"Id": 1, "UId": "a", "EMAIL": "foo@example.com", "C_LIST": [1, 2]},
+        {"Id": 2, "UId": "b", "EMAIL": "bar@example.com", "C_LIST": []},
+        {"Id": 3, "UId": "c", "EMAIL": "", "C_NESTED": {"x": "}]"}},
+    ],
+    "@odata.count": 3,
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 10_000])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_decoder_chunks(chunk_size: int, indent: int | None) -> None:
+    """Test that the decoder handles responses split at arbitrary positions."""
+    body = json.dumps(RESPONSE, indent=indent)
+    decoder = ODataDecoder()
+    items = []
+    for i in range(0, len(body), chunk_size):
+        items.extend(decoder.feed(body[i : i + chunk_size]))
+    items.extend(decoder.close())
+    assert items == RESPONSE["value"]
+    assert decoder.metadata == {
+        "@odata.context": RESPONSE["@odata.context"],
+        "@odata.count": 3,
+    }
+
+
+def test_decoder_yields_items_early() -> None:
+    """Test that items are returned before the response is complete."""
+    decoder = ODataDecoder()
+    assert decoder.feed('{"value": [{"Id": 1}, {"Id"') == [{"Id": 1}]
+    assert decoder.feed(": 2}]}") == [{"Id": 2}]
+    assert decoder.close() == []
+
+
+def test_decoder_empty() -> None:
+    decoder = ODataDecoder()
+    assert decoder.feed('{"value": []}') == []
+    assert decoder.close() == []
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        '{"value": [{"Id": 1}',
+        '{"@odata.context": "x"}',
+        '["value"]',
+    ],
+)
+def test_decoder_invalid(body: str) -> None:
+    decoder = ODataDecoder()
+    with pytest.raises(ValueError):
+        decoder.feed(body)
+        decoder.close()
@@ -0,0 +1,48 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+import asyncio
+
+import pytest
+
+from os2mint_omada.omada.ratelimit import Priority
+from os2mint_omada.omada.ratelimit import RateLimiter
+
+
+async def test_burst() -> None:
+    """Test that requests within the burst are not delayed."""
+    limiter = RateLimiter(rate=0.001, burst=3)
+    for _ in range(3):
+        await asyncio.wait_for(limiter.acquire(Priority.NORMAL), timeout=1)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(limiter.acquire(Priority.NORMAL), timeout=0.05)
+
+
+async def test_priority() -> None:
+    """Test that waiting requests are granted tokens in order of priority."""
+    limiter = RateLimiter(rate=100, burst=1)
+    await limiter.acquire(Priority.NORMAL)
+    order: list[str] = []
+
+    async def request(name: str, priority: Priority) -> None:
+        await limiter.acquire(priority)
+        order.append(name)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(request("refresh-1", Priority.LOW))
+        tg.create_task(request("refresh-2", Priority.LOW))
+        tg.create_task(request("update", Priority.NORMAL))
+        tg.create_task(request("create", Priority.HIGH))
+        tg.create_task(request("view", Priority.VIEW))
+
+    assert order == ["view", "create", "update", "refresh-1", "refresh-2"]
+
+
+async def test_cancelled_waiter() -> None:
+    """Test that cancelled waiters do not consume tokens."""
+    limiter = RateLimiter(rate=20, burst=1)
+    await limiter.acquire(Priority.NORMAL)
+    cancelled = asyncio.create_task(limiter.acquire(Priority.HIGH))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.wait_for(limiter.acquire(Priority.LOW), timeout=1)
+    assert cancelled.cancelled()
@@ -0,0 +1,60 @@
+# SPDX-FileCopyrightText: Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+import time
+
+import pytest
+
+from os2mint_omada.omada.snapshot import OmadaSnapshot
+from os2mint_omada.omada.snapshot import parse_eq_filter
+
+USERS = [
+    {"Id": 1, "UId": "a", "C_CPRNUMBER": "010101-1234"},
+    {"Id": 2, "UId": "b", "C_CPRNUMBER": "0101011234"},
+    {"Id": 3, "UId": "c", "C_CPRNUMBER": ""},
+]
+
+
+def test_lookup() -> None:
+    snapshot = OmadaSnapshot(USERS, timestamp=time.monotonic())
+    assert snapshot.lookup("Id", 2) == [USERS[1]]
+    assert snapshot.lookup("UId", "c") == [USERS[2]]
+    assert snapshot.lookup("Id", 4) == []
+
+
+def test_lookup_cpr() -> None:
+    """Test that CPR numbers are matched exactly, like the Omada API."""
+    snapshot = OmadaSnapshot(USERS, timestamp=time.monotonic())
+    assert snapshot.lookup("C_CPRNUMBER", "010101-1234") == [USERS[0]]
+    assert snapshot.lookup("C_CPRNUMBER", "0101011234") == [USERS[1]]
+    assert snapshot.lookup("C_CPRNUMBER", "") == [USERS[2]]
+
+
+def test_age() -> None:
+    snapshot = OmadaSnapshot(USERS, timestamp=time.monotonic() - 10)
+    assert 10 <= snapshot.age < 20
+
+
+@pytest.mark.parametrize(
+    "omada_filter,expected",
+    [
+        ("Id eq 1", ("Id", 1)),
+        ("Id eq -1", ("Id", -1)),
+        ("C_CPRNR eq '010101-1234'", ("C_CPRNR", "010101-1234")),
+        ("EMAIL eq ''", ("EMAIL", "")),
+        ("Id eq 1 or Id eq 2", None),
+        ("Id ge 1", None),
+    ],
+)
+def test_parse_eq_filter(omada_filter: str, expected: tuple | None) -> None:
+    assert parse_eq_filter(omada_filter) == expected
+
+
+def test_query() -> None:
+    """Test that queries on any attribute are answered, if supported."""
+    users = [*USERS, {"Id": 4, "EMAIL": "d@example.com"}]
+    snapshot = OmadaSnapshot(users, timestamp=time.monotonic())
+    assert snapshot.query(None) == users
+    assert snapshot.query("UId eq 'b'") == [users[1]]
+    assert snapshot.query("EMAIL eq 'd@example.com'") == [users[3]]
+    assert snapshot.query("EMAIL eq 'e@example.com'") == []
+    assert snapshot.query("Id ge 2") is None